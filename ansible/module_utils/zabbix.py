@@ -2,32 +2,1102 @@
 """Ansible module utility classes for Zabbix
 """
 
-try:
-    from zabbix_api import ZabbixAPI
-    HAS_ZABBIX_API = True
-except ImportError:
-    HAS_ZABBIX_API = False
+import contextlib
+import errno
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+# Modules run in a fresh process, so this is when the module started
+_ZBX_STARTED = time.time()
 
 def zbx_argument_spec():
     return dict(
-        server_url=dict(type='str', required=True, aliases=['url']),
-        login_user=dict(type='str', required=True),
-        login_password=dict(type='str', required=True, no_log=True),
+        # Not required when running over the zabbix httpapi connection
+        server_url=dict(type='str', required=False, default=None, aliases=['url']),
+        login_user=dict(type='str', required=False, default=None),
+        login_password=dict(type='str', required=False, default=None, no_log=True),
         http_login_user=dict(type='str', required=False, default=None),
         http_login_password=dict(type='str', required=False, default=None, no_log=True),
         timeout=dict(type='int', default=10),
+        session_cache=dict(type='bool', default=True),
+        cache_dir=dict(type='str', default='~/.ansible/zabbix'),
+        logout=dict(type='bool', default=False),
+        cache_ttl=dict(type='int', default=0),
+        retries=dict(type='int', default=3),
+        retry_delay=dict(type='float', default=0.5),
+        retry_max_delay=dict(type='float', default=10),
+        circuit_threshold=dict(type='int', default=5),
+        circuit_reset=dict(type='int', default=30),
+        rate_limit=dict(type='float', default=0),
+        rate_burst=dict(type='int', default=10),
+        max_concurrency=dict(type='int', default=0),
+        debug=dict(type='bool', default=False),
+        profile=dict(type='bool', default=False),
     )
 
+def zbx_state_file(cache_dir, kind, *key):
+    """Return the path of a controller-local state file, creating its directory"""
+    directory = os.path.join(os.path.expanduser(cache_dir), kind)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    digest = hashlib.sha256('\0'.join(key).encode('utf-8')).hexdigest()
+    return os.path.join(directory, digest)
+
+@contextlib.contextmanager
+def zbx_file_lock(path):
+    """Hold an exclusive lock on path, shared by all forks on the controller"""
+    import fcntl
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # Closing the descriptor releases the lock
+        os.close(fd)
+
+class ZabbixSessionCache(object):
+    """Controller-local store of authenticated API sessions
+
+    Sessions are keyed by a digest of all credentials, so a task with other
+    or wrong credentials never reuses the session of another login.
+    """
+
+    def __init__(self, cache_dir, server_url, login_user, login_password,
+                 http_login_user=None, http_login_password=None):
+        credentials = hashlib.sha256('\0'.join([
+            login_password or '', http_login_user or '', http_login_password or ''
+        ]).encode('utf-8')).hexdigest()
+        self.path = zbx_state_file(cache_dir, 'sessions', server_url, login_user, credentials)
+
+    def load(self):
+        """Return the cached session id, or None"""
+        try:
+            with open(self.path, 'r') as cache_file:
+                return json.load(cache_file).get('auth')
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, auth):
+        """Atomically store a session id readable only by the current user"""
+        tmp_path = '%s.%d' % (self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump({'auth': auth, 'created': time.time()}, cache_file)
+        os.rename(tmp_path, self.path)
+
+    def clear(self):
+        """Forget the cached session"""
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+class ZabbixAPIException(Exception):
+    """Raised when an API call fails"""
+
+    def __init__(self, msg, code=None):
+        super(ZabbixAPIException, self).__init__(msg)
+        self.code = code
+
+class ZabbixTransportError(ZabbixAPIException):
+    """Raised when a request fails below the JSON-RPC layer
+
+    transient is set for failures worth retrying, sent is cleared when the
+    server cannot have processed the request.
+    """
+
+    def __init__(self, msg, code=None, transient=True, sent=True):
+        super(ZabbixTransportError, self).__init__(msg, code)
+        self.transient = transient
+        self.sent = sent
+
+# HTTP statuses of an overloaded frontend, 429 and 503 are returned before
+# the request is processed
+ZBX_TRANSIENT_STATUS = (429, 500, 502, 503, 504)
+ZBX_UNSENT_STATUS = (429, 503)
+
+# Error data of calls made with a session that was logged out or expired
+ZBX_SESSION_ERRORS = ('Session terminated', 'Not authorised', 'Not authorized')
+
+def zbx_session_error(response):
+    """Tell whether a JSON-RPC response was rejected for its session"""
+    data = str(response.get('error', {}).get('data', ''))
+    return any([marker in data for marker in ZBX_SESSION_ERRORS])
+
+# Methods that can be repeated without side effects
+ZBX_READ_ACTIONS = ('get', 'version', 'checkAuthentication', 'login')
+
+def zbx_read_only(method):
+    """Tell whether method, or every method of a batch, only reads"""
+    return all([
+        name.split('.', 1)[-1] in ZBX_READ_ACTIONS for name in method.split(',')
+    ])
+
+class ZabbixCircuitOpen(ZabbixAPIException):
+    """Raised instead of calling a server that keeps failing"""
+
+class ZabbixCircuitBreaker(object):
+    """Failure counter of one server shared by all forks through cache_dir
+
+    After threshold consecutive calls failed with a transient error, once
+    their retries were exhausted, calls fail fast for reset_timeout seconds,
+    then a single failed call opens the circuit again until a call succeeds.
+    Concurrent updates may lose a count, which only delays opening the
+    circuit.
+    """
+
+    def __init__(self, cache_dir, server_url, threshold, reset_timeout):
+        self.path = zbx_state_file(cache_dir, 'circuits', server_url)
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as state_file:
+                return json.load(state_file)
+        except (IOError, OSError, ValueError):
+            return {'failures': 0, 'opened': 0}
+
+    def _save(self, state):
+        """Store state, a failure only loses the count, never the call's error"""
+        tmp_path = '%s.%d.%d' % (self.path, os.getpid(), threading.current_thread().ident)
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as state_file:
+                json.dump(state, state_file)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            pass
+
+    def check(self):
+        """Raise ZabbixCircuitOpen while the circuit is open"""
+        state = self._load()
+        if state['failures'] < self.threshold:
+            return
+        retry_in = state['opened'] + self.reset_timeout - time.time()
+        if retry_in > 0:
+            raise ZabbixCircuitOpen(
+                "Circuit open after %d consecutive failures, retrying in %ds"
+                % (state['failures'], retry_in + 1)
+            )
+
+    def success(self):
+        if self._load()['failures']:
+            self._save({'failures': 0, 'opened': 0})
+
+    def failure(self):
+        state = self._load()
+        state['failures'] += 1
+        if state['failures'] >= self.threshold:
+            state['opened'] = time.time()
+        self._save(state)
+
+class ZabbixRetryPolicy(object):
+    """Retries transient failures with exponential backoff and full jitter
+
+    Reads are retried after any transient failure, writes only when the
+    request cannot have reached the API.
+    """
+
+    def __init__(self, retries=3, delay=0.5, max_delay=10, breaker=None):
+        self.retries = retries
+        self.delay = delay
+        self.max_delay = max_delay
+        self.breaker = breaker
+        self.retried = 0
+
+    def _retryable(self, error, read_only):
+        return error.transient and (read_only or not error.sent)
+
+    def run(self, method, send):
+        """Return send(), retrying it according to the policy"""
+        read_only = zbx_read_only(method)
+        if self.breaker is not None:
+            self.breaker.check()
+        attempt = 0
+        while True:
+            try:
+                result = send()
+            except ZabbixTransportError as e:
+                if attempt >= self.retries or not self._retryable(e, read_only):
+                    # A call counts as one failure whatever its retries
+                    if self.breaker is not None and e.transient:
+                        self.breaker.failure()
+                    raise
+            else:
+                if self.breaker is not None:
+                    self.breaker.success()
+                return result
+            time.sleep(random.uniform(0, min(self.max_delay, self.delay * 2 ** attempt)))
+            attempt += 1
+            self.retried += 1
+
+class ZabbixRateLimiter(object):
+    """Token bucket and concurrency cap of one server, shared by all forks
+
+    The bucket refills at rate requests per second up to burst tokens and
+    lives in a state file guarded by a lock under cache_dir. At most
+    concurrency requests are in flight at once, each holding a lock on one
+    of as many slot files. Locks die with their process, so a killed fork
+    never leaks a slot.
+    """
+
+    def __init__(self, cache_dir, server_url, rate=0, burst=10, concurrency=0):
+        self.path = zbx_state_file(cache_dir, 'ratelimit', server_url)
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.concurrency = concurrency
+
+    def _take_token(self):
+        """Take a token, return how long to wait for one if there is none"""
+        with zbx_file_lock(self.path + '.lock'):
+            now = time.time()
+            try:
+                with open(self.path, 'r') as state_file:
+                    state = json.load(state_file)
+                tokens = min(
+                    self.burst,
+                    state['tokens'] + (now - state['updated']) * self.rate
+                )
+            except (IOError, OSError, ValueError, KeyError):
+                tokens = self.burst
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            with open(self.path, 'w') as state_file:
+                json.dump({'tokens': tokens, 'updated': now}, state_file)
+        return wait
+
+    def _take_slot(self):
+        """Return the locked descriptor of a free slot, or None"""
+        import fcntl
+        for slot in range(self.concurrency):
+            fd = os.open('%s.slot%d' % (self.path, slot), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except (IOError, OSError):
+                os.close(fd)
+        return None
+
+    def call(self, send):
+        """Return send() and the seconds spent waiting for the limits"""
+        started = time.time()
+        if self.rate > 0:
+            wait = self._take_token()
+            while wait:
+                time.sleep(wait)
+                wait = self._take_token()
+        slot = None
+        if self.concurrency > 0:
+            delay = 0.005
+            slot = self._take_slot()
+            while slot is None:
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+                slot = self._take_slot()
+        waited = time.time() - started
+        try:
+            return send(), waited
+        finally:
+            if slot is not None:
+                os.close(slot)
+
+class ZabbixStreamedString(object):
+    """Request parameter whose string value is read from a file when sent
+
+    opener returns a new binary file object for every pass over the value,
+    whose UTF-8 content is JSON escaped one chunk at a time.
+    """
+
+    def __init__(self, opener):
+        self._opener = opener
+
+    def json_chunks(self, size):
+        import codecs
+        decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        yield b'"'
+        source = self._opener()
+        try:
+            while True:
+                data = source.read(size)
+                text = decoder.decode(data, final=not data)
+                if text:
+                    yield json.dumps(text)[1:-1].encode('ascii')
+                if not data:
+                    break
+        finally:
+            source.close()
+        yield b'"'
+
+def _stream_marker(index):
+    return '\0zabbix-stream-%d\0' % index
+
+class ZabbixStreamedBody(object):
+    """JSON-RPC request body with ZabbixStreamedString members
+
+    The body is generated once to compute its Content-Length and once more to
+    send it, so only a chunk of each streamed file is held in memory.
+    """
+    chunk_size = 65536
+
+    def __init__(self, text, streams):
+        self._parts = []
+        for index, stream in enumerate(streams):
+            before, text = text.split(json.dumps(_stream_marker(index)), 1)
+            self._parts.extend([before.encode('utf-8'), stream])
+        self._parts.append(text.encode('utf-8'))
+        self._length = None
+
+    def chunks(self):
+        for part in self._parts:
+            if isinstance(part, bytes):
+                yield part
+            else:
+                for chunk in part.json_chunks(self.chunk_size):
+                    yield chunk
+
+    def __len__(self):
+        if self._length is None:
+            self._length = sum([len(chunk) for chunk in self.chunks()])
+        return self._length
+
+    def reader(self):
+        """Return a file object reading the body, as the HTTP client expects"""
+        return _ChunkReader(self.chunks())
+
+    def getvalue(self):
+        return b''.join(self.chunks())
+
+class _ChunkReader(object):
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+def zbx_encode_request(payload):
+    """Serialize a JSON-RPC payload, streaming its ZabbixStreamedString members"""
+    streams = []
+
+    def marker(value):
+        if not isinstance(value, ZabbixStreamedString):
+            raise TypeError("%r is not JSON serializable" % value)
+        streams.append(value)
+        return _stream_marker(len(streams) - 1)
+    text = json.dumps(payload, default=marker)
+    if not streams:
+        return text.encode('utf-8')
+    return ZabbixStreamedBody(text, streams)
+
+def _http_client():
+    """Import the HTTP client on first use, it is not needed to build requests"""
+    try:
+        import http.client as http_client
+    except ImportError:
+        import httplib as http_client
+    return http_client
+
+def _urlparse(url):
+    try:
+        from urllib.parse import urlparse
+    except ImportError:
+        from urlparse import urlparse
+    return urlparse(url)
+
+class ZabbixConnectionPool(object):
+    """Thread-safe pool of keep-alive HTTP(S) connections to one API endpoint"""
+
+    def __init__(self, url, timeout):
+        http_client = _http_client()
+        parsed = _urlparse(url)
+        self.path = parsed.path or '/'
+        if parsed.query:
+            self.path += '?' + parsed.query
+        if parsed.scheme == 'https':
+            self._connection_class = http_client.HTTPSConnection
+        else:
+            self._connection_class = http_client.HTTPConnection
+        self._errors = (http_client.HTTPException, EnvironmentError)
+        self._host = parsed.hostname
+        self._port = parsed.port
+        self._timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            conn_stats = {'connection': len(self._connections), 'requests': 0}
+            self._connections.append(conn_stats)
+        conn = self._connection_class(self._host, self._port, timeout=self._timeout)
+        return conn, conn_stats
+
+    def _release(self, pooled):
+        with self._lock:
+            self._idle.append(pooled)
+
+    def _dropped(self, error):
+        """Tell whether error means an idle connection was closed before any response"""
+        http_client = _http_client()
+        remote_disconnected = getattr(http_client, 'RemoteDisconnected', None)
+        if remote_disconnected is not None:
+            if isinstance(error, remote_disconnected):
+                return True
+        elif isinstance(error, http_client.BadStatusLine) and error.line in ('', "''"):
+            # Python 2 reports a connection closed without a status line this way
+            return True
+        return getattr(error, 'errno', None) in (errno.EPIPE, errno.ECONNRESET)
+
+    def request(self, body, headers):
+        """POST body, bytes or a ZabbixStreamedBody, and return the decoded response"""
+        if isinstance(body, ZabbixStreamedBody):
+            headers = dict(headers)
+            headers['Content-Length'] = str(len(body))
+        conn, conn_stats = self._acquire()
+        reused = conn_stats['requests'] > 0
+        if not reused:
+            try:
+                conn.connect()
+            except self._errors as e:
+                conn.close()
+                raise ZabbixTransportError("Connection failed: %s" % e, sent=False)
+        try:
+            conn.request(
+                'POST', self.path,
+                body.reader() if isinstance(body, ZabbixStreamedBody) else body,
+                headers
+            )
+            response = conn.getresponse()
+            data = response.read()
+        except self._errors as e:
+            conn.close()
+            if not reused or not self._dropped(e):
+                raise ZabbixTransportError("Request failed: %s" % e, sent=True)
+            # The server closed an idle keep-alive connection before it
+            # received the request, so it is safe to resend on a new one
+            return self.request(body, headers)
+        with self._lock:
+            conn_stats['requests'] += 1
+        if response.getheader('connection', '').lower() == 'close':
+            conn.close()
+        else:
+            self._release((conn, conn_stats))
+        if response.status != 200:
+            raise ZabbixTransportError(
+                "HTTP error %s: %s" % (response.status, response.reason),
+                response.status,
+                transient=response.status in ZBX_TRANSIENT_STATUS,
+                sent=response.status not in ZBX_UNSENT_STATUS
+            )
+        if response.getheader('content-encoding', '').lower() == 'gzip':
+            import zlib
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        return data
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+    def stats(self):
+        """Return per-connection request and reuse counters"""
+        with self._lock:
+            connections = [
+                dict(conn_stats, reused=max(conn_stats['requests'] - 1, 0))
+                for conn_stats in self._connections
+            ]
+        requests = sum([c['requests'] for c in connections])
+        return dict(
+            opened=len(connections),
+            requests=requests,
+            reused=requests - len([c for c in connections if c['requests']]),
+            connections=connections,
+        )
+
+class ZabbixHttpApiTransport(object):
+    """Sends requests over the persistent connection of the zabbix httpapi plugin
+
+    The plugin replaces the auth member of every request with the session of
+    the play, so modules neither log in nor open connections themselves.
+    """
+
+    def __init__(self, socket_path):
+        from ansible.module_utils.connection import Connection
+        self._connection = Connection(socket_path)
+        self._requests = 0
+
+    def request(self, body, headers):
+        """Send body through the plugin and return the response payload"""
+        self._requests += 1
+        if isinstance(body, ZabbixStreamedBody):
+            body = body.getvalue()
+        return self._connection.send_request(body.decode('utf-8')).encode('utf-8')
+
+    def endpoint(self):
+        """Return the API URL of the persistent connection"""
+        return self._connection.endpoint()
+
+    def close(self):
+        """The persistent connection outlives the module"""
+        pass
+
+    def stats(self):
+        return dict(persistent=True, requests=self._requests)
+
+class ZabbixAPIObject(object):
+    """Turns zapi.<object>.<method>(params) into an API call"""
+
+    def __init__(self, zapi, name):
+        self._zapi = zapi
+        self._name = name
+
+    def __getattr__(self, method):
+        if method.startswith('__'):
+            raise AttributeError(method)
+        if method == 'import_':
+            method = 'import'
+
+        def api_method(params=None):
+            return self._zapi.call('%s.%s' % (self._name, method), params)
+        return api_method
+
+class ZabbixAPI(object):
+    """Dependency-free Zabbix JSON-RPC client
+
+    Requests go through pool, a ZabbixConnectionPool, and every request is
+    reported to the callables in hooks as hook(method, duration,
+    request_bytes, response_bytes, waited, error), method lists the comma
+    separated methods of a batch, waited the seconds spent in limiter, an
+    optional ZabbixRateLimiter, and error is set when the request failed.
+
+    When projection is a list, every get with an output field list is
+    repeated with output extend and the response sizes are appended to it.
+    Failed requests are retried according to retry, a ZabbixRetryPolicy.
+    Calls rejected for their session are sent once more after relogin, when
+    set, renewed auth.
+    """
+
+    def __init__(self, server, timeout=10, user=None, passwd=None, pool=None,
+                 retry=None, limiter=None):
+        self.url = server + '/api_jsonrpc.php'
+        self.timeout = timeout
+        self.auth = ''
+        self.id = 0
+        self.hooks = []
+        self.projection = None
+        self.relogin = None
+        self._relogin_lock = threading.Lock()
+        self._headers = {
+            'Content-Type': 'application/json-rpc',
+            'User-Agent': 'ansible-modules-zabbix',
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive',
+        }
+        if user:
+            import base64
+            credentials = ('%s:%s' % (user, passwd or '')).encode('utf-8')
+            self._headers['Authorization'] = (
+                'Basic ' + base64.b64encode(credentials).decode('ascii')
+            )
+        self.pool = pool or ZabbixConnectionPool(self.url, timeout)
+        self.retry = retry or ZabbixRetryPolicy(retries=0)
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return ZabbixAPIObject(self, name)
+
+    def _post(self, method, payload):
+        """Send a JSON-RPC payload and return the decoded response"""
+        body = zbx_encode_request(payload)
+        waits = []
+
+        def send():
+            if self.limiter is None:
+                return self.pool.request(body, self._headers)
+            data, waited = self.limiter.call(lambda: self.pool.request(body, self._headers))
+            waits.append(waited)
+            return data
+        started = time.time()
+        data = None
+        try:
+            data = self.retry.run(method, send)
+        finally:
+            # Failed and timed out requests are reported too
+            waited = sum(waits)
+            duration = time.time() - started - waited
+            for hook in self.hooks:
+                hook(method, duration, len(body), len(data or b''), waited, data is None)
+        return json.loads(data.decode('utf-8'))
+
+    def _renew(self, auth):
+        """Log in again unless another thread already replaced auth"""
+        if self.relogin is None:
+            return False
+        with self._relogin_lock:
+            if self.auth == auth:
+                self.relogin()
+        return True
+
+    def call(self, method, params=None, auth=True):
+        """Call an API method and return its result"""
+        request = {
+            'jsonrpc': '2.0',
+            'method': method,
+            'params': params if params is not None else {},
+            'id': self.id,
+        }
+        if auth:
+            request['auth'] = self.auth
+        self.id += 1
+        response = self._post(method, request)
+        if (auth and method != 'user.logout' and zbx_session_error(response) and
+                self._renew(request['auth'])):
+            # The server rejects calls with a dead session before running them
+            request['auth'] = self.auth
+            response = self._post(method, request)
+        if 'error' in response:
+            error = response['error']
+            raise ZabbixAPIException(
+                "Error %s: %s, %s" % (error['code'], error['message'], error.get('data')),
+                error['code']
+            )
+        if self.projection is not None:
+            self._measure_projection(method, params, response.get('result'))
+        return response.get('result')
+
+    def _measure_projection(self, method, params, result):
+        """Record the response bytes a projected get saved over output extend"""
+        if not method.endswith('.get') or not isinstance(params, dict):
+            return
+        if not isinstance(params.get('output'), list):
+            return
+        projection, self.projection = self.projection, None
+        try:
+            extended = self.call(method, dict(params, output='extend'))
+        except ZabbixAPIException:
+            return
+        finally:
+            self.projection = projection
+        response_bytes = len(json.dumps(result))
+        extend_bytes = len(json.dumps(extended))
+        projection.append(dict(
+            method=method,
+            response_bytes=response_bytes,
+            extend_bytes=extend_bytes,
+            saved_bytes=extend_bytes - response_bytes,
+        ))
+
+    def login(self, user, password):
+        """Log in and keep the session id for later calls"""
+        self.auth = self.call('user.login', {'user': user, 'password': password}, auth=False)
+
+    def check_authentication(self, sessionid):
+        """Return the session data of sessionid, raise if it is not valid"""
+        return self.call('user.checkAuthentication', {'sessionid': sessionid}, auth=False)
+
+    def logout(self):
+        """End the current session"""
+        if self.auth:
+            self.call('user.logout', [])
+            self.auth = ''
+
+    def do_batch(self, calls):
+        """Send ZabbixBatchCall objects as one JSON-RPC batch request"""
+        if not calls:
+            return
+        requests = []
+        by_id = {}
+        auth = self.auth
+        # Ids only need to be unique within the batch
+        for request_id, call in enumerate(calls):
+            requests.append({
+                'jsonrpc': '2.0',
+                'method': call.method,
+                'params': call.params,
+                'auth': auth,
+                'id': request_id,
+            })
+            by_id[request_id] = call
+        method = ','.join([call.method for call in calls])
+        responses = self._post(method, requests)
+        listed = responses if isinstance(responses, list) else [responses]
+        if all([zbx_session_error(response) for response in listed]) and self._renew(auth):
+            for request in requests:
+                request['auth'] = self.auth
+            responses = self._post(method, requests)
+        if isinstance(responses, dict):
+            # A single error object is returned when the batch itself is invalid
+            responses = [dict(responses, id=request_id) for request_id in by_id]
+        for response in responses:
+            call = by_id.pop(response.get('id'), None)
+            if call is None:
+                continue
+            if 'error' in response:
+                error = response['error']
+                call.error = "Error %s: %s, %s" % (
+                    error['code'], error['message'], error.get('data')
+                )
+            else:
+                call.result = response.get('result')
+        for call in by_id.values():
+            call.error = "No response received"
+        if self.projection is not None:
+            for call in calls:
+                if call.error is None:
+                    self._measure_projection(call.method, call.params, call.result)
+
+class ZabbixBatchCall(object):
+    """A queued API call, result or error is set once the batch is sent"""
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self.result = None
+        self.error = None
+
+class ZabbixBatchError(ZabbixAPIException):
+    """Raised when one or more calls of a batch failed"""
+
+    def __init__(self, calls):
+        self.calls = calls
+        super(ZabbixBatchError, self).__init__('; '.join([
+            "%s: %s" % (call.method, call.error) for call in calls
+        ]))
+
+class ZabbixBatch(object):
+    """Queue API calls as batch.<object>.<method>(params) and send them at once"""
+
+    def __init__(self, zapi):
+        self._zapi = zapi
+        self.calls = []
+
+    def __getattr__(self, name):
+        batch = self
+
+        class _Object(object):
+            def __getattr__(self, method):
+                if method == 'import_':
+                    method = 'import'
+                return lambda params: batch.add('%s.%s' % (name, method), params)
+        return _Object()
+
+    def add(self, method, params):
+        """Queue a call and return its ZabbixBatchCall"""
+        call = ZabbixBatchCall(method, params)
+        self.calls.append(call)
+        return call
+
+    def send(self):
+        """Send the queued calls, raise ZabbixBatchError if any of them failed"""
+        calls, self.calls = self.calls, []
+        self._zapi.do_batch(calls)
+        failed = [call for call in calls if call.error is not None]
+        if failed:
+            raise ZabbixBatchError(failed)
+        return calls
+
+# Fields the modules read or diff, requested instead of output extend
+ZBX_OUTPUT_FIELDS = {
+    'hostgroup': ('groupid', 'name'),
+    'hostmacro': ('hostmacroid', 'macro', 'value'),
+    'mapping': ('value', 'newvalue'),
+    'right': ('id', 'permission'),
+    'template': ('templateid', 'host'),
+    'user': ('userid', 'alias', 'name', 'surname', 'type'),
+    'usergroup': ('usrgrpid', 'name', 'debug_mode', 'gui_access', 'users_status'),
+    'usermacro': ('globalmacroid', 'macro', 'value'),
+    'usrgrp': ('usrgrpid',),
+    'valuemap': ('valuemapid', 'name'),
+}
+
+def zbx_output(object_type):
+    """Return the output (or select*) field list of object_type"""
+    return list(ZBX_OUTPUT_FIELDS[object_type])
+
+# Bulk get requests of the object types kept in the snapshot cache
+ZBX_SNAPSHOT_REQUESTS = {
+    'hostgroup': {'output': zbx_output('hostgroup')},
+    'template': {'output': zbx_output('template')},
+    'usergroup': {'output': ['usrgrpid', 'name']},
+    'usermacro': {'globalmacro': True, 'output': zbx_output('usermacro')},
+}
+
+# Snapshot types invalidated by writes to other objects
+ZBX_SNAPSHOT_WRITES = {
+    'configuration.import': ('hostgroup', 'template'),
+}
+
+class ZabbixSnapshotCache(object):
+    """Controller-local snapshots of whole object types, kept for ttl seconds
+
+    Snapshots are replaced atomically, so any number of forks can read them
+    while another one refreshes or invalidates them.
+    """
+
+    def __init__(self, cache_dir, server_url, ttl):
+        self._cache_dir = cache_dir
+        self._server_url = server_url or ''
+        self.ttl = ttl
+
+    def _path(self, object_type):
+        return zbx_state_file(self._cache_dir, 'snapshots', self._server_url, object_type)
+
+    def load(self, object_type):
+        """Return the cached objects of object_type, or None if expired"""
+        if object_type not in ZBX_SNAPSHOT_REQUESTS:
+            return None
+        try:
+            with open(self._path(object_type), 'r') as cache_file:
+                snapshot = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if time.time() - snapshot.get('created', 0) > self.ttl:
+            return None
+        return snapshot.get('objects')
+
+    def save(self, object_type, objects):
+        """Atomically replace the snapshot of object_type"""
+        path = self._path(object_type)
+        tmp_path = '%s.%d.%d' % (path, os.getpid(), threading.current_thread().ident)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump({'created': time.time(), 'objects': objects}, cache_file)
+        os.rename(tmp_path, path)
+
+    def fetch(self, zapi, object_type):
+        """Return the objects of object_type, refreshing the snapshot if needed"""
+        objects = self.load(object_type)
+        if objects is None:
+            objects = getattr(zapi, object_type).get(ZBX_SNAPSHOT_REQUESTS[object_type])
+            self.save(object_type, objects)
+        return objects
+
+    def invalidate(self, object_type):
+        """Drop the snapshot of object_type"""
+        try:
+            os.unlink(self._path(object_type))
+        except OSError:
+            pass
+
+    def invalidate_writes(self, method):
+        """hook for ZabbixAPI.hooks dropping the snapshots a call may have changed"""
+        for name in method.split(','):
+            object_type, action = name.split('.', 1)
+            if action in ('get', 'checkAuthentication', 'login', 'logout'):
+                continue
+            for stale in ZBX_SNAPSHOT_WRITES.get(name, (object_type,)):
+                if stale in ZBX_SNAPSHOT_REQUESTS:
+                    self.invalidate(stale)
+                _ZBX_RESOLVED_IDS.pop((self._server_url, stale), None)
+
+# Id and name fields of the objects ZabbixNameResolver can look up
+ZBX_NAME_FIELDS = {
+    'hostgroup': ('groupid', 'name'),
+    'template': ('templateid', 'host'),
+    'user': ('userid', 'alias'),
+    'usergroup': ('usrgrpid', 'name'),
+}
+
+# Resolved ids per (server_url, object type), kept for the life of the process
+_ZBX_RESOLVED_IDS = {}
+
+class ZabbixResolveError(ZabbixAPIException):
+    """Raised with every name that does not exist on the server"""
+
+    def __init__(self, object_type, names):
+        self.object_type = object_type
+        self.names = names
+        super(ZabbixResolveError, self).__init__(
+            "%s %s not found" % (object_type, ', '.join(names))
+        )
+
+class ZabbixNameResolver(object):
+    """Memoized lookup of object ids by name with one filtered get per type
+
+    With a ZabbixSnapshotCache, names are resolved from the snapshot of their
+    type and names missing from it are looked up on the server.
+    """
+
+    def __init__(self, zapi, server_url, snapshots=None):
+        self._zapi = zapi
+        self._server_url = server_url or ''
+        self._snapshots = snapshots
+        self._pending = []
+
+    def _known(self, object_type):
+        return _ZBX_RESOLVED_IDS.setdefault((self._server_url, object_type), {})
+
+    def _request(self, object_type, names):
+        id_field, name_field = ZBX_NAME_FIELDS[object_type]
+        return {
+            'output': [id_field, name_field],
+            'filter': {
+                name_field: names
+            }
+        }
+
+    def _store(self, object_type, names, objects):
+        id_field, name_field = ZBX_NAME_FIELDS[object_type]
+        known = self._known(object_type)
+        for name in names:
+            known[name] = None
+        for obj in objects:
+            known[obj[name_field]] = obj[id_field]
+
+    def _unknown(self, object_type, names):
+        known = self._known(object_type)
+        return sorted(set([name for name in names if name not in known]))
+
+    def _snapshot(self, batch, object_type, names):
+        """Resolve names from the snapshot, queue its refresh in batch if expired"""
+        if self._snapshots is None or object_type not in ZBX_SNAPSHOT_REQUESTS:
+            return False
+        objects = self._snapshots.load(object_type)
+        if objects is None:
+            call = batch.add(
+                '%s.get' % object_type, ZBX_SNAPSHOT_REQUESTS[object_type]
+            )
+            self._pending.append((object_type, names, call))
+            return True
+        # Only trust positive hits, names created since are looked up below
+        self._store(object_type, [], objects)
+        return False
+
+    def queue(self, batch, object_type, names):
+        """Queue the lookup of names in batch, resolve() uses the result once sent"""
+        names = self._unknown(object_type, names)
+        if names and self._snapshot(batch, object_type, names):
+            return
+        names = self._unknown(object_type, names)
+        if names:
+            call = batch.add(
+                '%s.get' % object_type, self._request(object_type, names)
+            )
+            self._pending.append((object_type, names, call))
+
+    def resolve(self, object_type, names):
+        """Return a dict mapping each of names to its id"""
+        pending, self._pending = self._pending, []
+        for pending_type, pending_names, call in pending:
+            if call.result is not None:
+                self._store(pending_type, pending_names, call.result)
+                if 'filter' not in call.params:
+                    self._snapshots.save(pending_type, call.result)
+        unknown = self._unknown(object_type, names)
+        if unknown and self._snapshots is not None and object_type in ZBX_SNAPSHOT_REQUESTS:
+            self._store(object_type, [], self._snapshots.fetch(self._zapi, object_type))
+            unknown = self._unknown(object_type, names)
+        if unknown:
+            objects = getattr(self._zapi, object_type).get(
+                self._request(object_type, unknown)
+            )
+            self._store(object_type, unknown, objects)
+        known = self._known(object_type)
+        missing = sorted(set([name for name in names if known[name] is None]))
+        if missing:
+            raise ZabbixResolveError(object_type, missing)
+        return dict([(name, known[name]) for name in names])
+
 class AnsibleZabbix(object):
 
     def __init__(self, module):
-        if not HAS_ZABBIX_API:
-            module.fail_json(msg="python library zabbix-api required: pip install zabbix-api")
-
         self._module = module
+        self._zapi = None
+        self._session_cache = None
+        self._httpapi = False
+        # Identifies the server in controller-local state shared by forks
+        self._endpoint = module.params['server_url']
+        self._timings = None
+        self._hook_exit()
+        started = time.time()
         self._connect()
+        if self._timings is not None:
+            self._timings['login'] = round(time.time() - started, 4)
+        if module.params.get('debug'):
+            self._zapi.projection = []
+        self._snapshots = None
+        if module.params.get('cache_ttl'):
+            self._snapshots = ZabbixSnapshotCache(
+                module.params['cache_dir'], self._endpoint,
+                module.params['cache_ttl']
+            )
+            self._zapi.hooks.append(
+                lambda method, *args: self._snapshots.invalidate_writes(method)
+            )
+        self._resolver = ZabbixNameResolver(
+            self._zapi, self._endpoint, self._snapshots
+        )
+
+    def _hook_exit(self):
+        """Run _on_exit before the module returns a result"""
+        def wrap(exit_method):
+            def wrapper(**kwargs):
+                self._on_exit(kwargs)
+                exit_method(**kwargs)
+            return wrapper
+        self._module.exit_json = wrap(self._module.exit_json)
+        self._module.fail_json = wrap(self._module.fail_json)
+
+    def _on_exit(self, result):
+        """Finalize the API session, result may be amended in place"""
+        if self._module.params.get('logout'):
+            self.logout()
+        if self._timings is not None:
+            self._timings['total'] = round(time.time() - _ZBX_STARTED, 4)
+            result['zbx_timings'] = self._timings
+        if self._zapi is not None:
+            if self._module.params.get('debug'):
+                debug = result.setdefault('zbx_debug', {})
+                debug['connections'] = self._zapi.pool.stats()
+                debug['retried'] = self._zapi.retry.retried
+                debug['projection'] = self._zapi.projection
+                debug['projection_saved_bytes'] = sum([
+                    call['saved_bytes'] for call in self._zapi.projection or []
+                ])
+            self._zapi.pool.close()
 
     def _connect(self):
+        socket_path = getattr(self._module, '_socket_path', None)
+        if socket_path:
+            self._connect_httpapi(socket_path)
+            return
+
+        missing = [
+            name for name in ('server_url', 'login_user', 'login_password')
+            if self._module.params.get(name) is None
+        ]
+        if missing:
+            self._module.fail_json(
+                msg="missing required arguments: %s" % ', '.join(missing)
+            )
+
         server_url = self._module.params['server_url']
         login_user = self._module.params['login_user']
         login_password = self._module.params['login_password']
@@ -40,8 +1110,161 @@ class AnsibleZabbix(object):
                 server_url,
                 timeout=timeout,
                 user=http_login_user,
-                passwd=http_login_password
+                passwd=http_login_password,
+                retry=self._retry_policy(),
+                limiter=self._rate_limiter()
             )
-            self._zapi.login(login_user, login_password)
+            self._instrument()
+            self._login(login_user, login_password)
+            self._zapi.relogin = lambda: self._relogin(login_user, login_password)
         except Exception as e:
             self._module.fail_json(msg="Failed to connect to Zabbix server: %s" % e)
+
+    def _instrument(self):
+        """Record every API call in zbx_timings when profile is enabled"""
+        if not self._module.params.get('profile'):
+            return
+        self._timings = {'calls': [], 'wait': 0}
+
+        def record(method, duration, request_bytes, response_bytes, waited, error):
+            self._timings['wait'] = round(self._timings['wait'] + waited, 4)
+            self._timings['calls'].append(dict(
+                method=method,
+                duration=round(duration, 4),
+                wait=round(waited, 4),
+                request_bytes=request_bytes,
+                response_bytes=response_bytes,
+                error=error,
+            ))
+        self._zapi.hooks.append(record)
+
+    def _rate_limiter(self):
+        params = self._module.params
+        if params['rate_limit'] <= 0 and params['max_concurrency'] <= 0:
+            return None
+        return ZabbixRateLimiter(
+            params['cache_dir'], self._endpoint,
+            rate=params['rate_limit'],
+            burst=params['rate_burst'],
+            concurrency=params['max_concurrency']
+        )
+
+    def _retry_policy(self):
+        params = self._module.params
+        breaker = None
+        if params['circuit_threshold'] > 0:
+            # Like the session cache, the breaker is off when cache_dir is unusable
+            try:
+                breaker = ZabbixCircuitBreaker(
+                    params['cache_dir'], self._endpoint,
+                    params['circuit_threshold'], params['circuit_reset']
+                )
+            except (IOError, OSError):
+                breaker = None
+        return ZabbixRetryPolicy(
+            retries=params['retries'],
+            delay=params['retry_delay'],
+            max_delay=params['retry_max_delay'],
+            breaker=breaker
+        )
+
+    def _connect_httpapi(self, socket_path):
+        """Use the session of a persistent zabbix httpapi connection"""
+        try:
+            transport = ZabbixHttpApiTransport(socket_path)
+            if not self._endpoint:
+                self._endpoint = transport.endpoint()
+            self._zapi = ZabbixAPI(
+                self._module.params['server_url'] or '',
+                pool=transport,
+                limiter=self._rate_limiter()
+            )
+        except Exception as e:
+            self._module.fail_json(msg="Failed to connect to Zabbix server: %s" % e)
+        self._instrument()
+        # Placeholder replaced by the plugin with the session of the play
+        self._zapi.auth = 'httpapi'
+        self._httpapi = True
+
+    def _login(self, login_user, login_password):
+        """Reuse a cached session when it is still valid, otherwise log in"""
+        params = self._module.params
+        if params['session_cache']:
+            try:
+                self._session_cache = ZabbixSessionCache(
+                    params['cache_dir'], params['server_url'], login_user, login_password,
+                    params['http_login_user'], params['http_login_password']
+                )
+            except (IOError, OSError):
+                self._session_cache = None
+        if self._session_cache is not None:
+            auth = self._session_cache.load()
+            if auth and self._check_session(auth):
+                self._zapi.auth = auth
+                return
+
+        self._zapi.login(login_user, login_password)
+
+        if self._session_cache is not None:
+            try:
+                self._session_cache.save(self._zapi.auth)
+            except (IOError, OSError):
+                pass
+
+    def _relogin(self, login_user, login_password):
+        """Replace a session another task logged out, sharing the new one"""
+        self._zapi.login(login_user, login_password)
+        if self._session_cache is not None:
+            try:
+                self._session_cache.save(self._zapi.auth)
+            except (IOError, OSError):
+                pass
+
+    def _check_session(self, auth):
+        """Cheap validity probe for a session id"""
+        try:
+            self._zapi.check_authentication(auth)
+            return True
+        except Exception:
+            return False
+
+    def batch(self):
+        """Return a ZabbixBatch sending its queued calls in a single request"""
+        return ZabbixBatch(self._zapi)
+
+    def cached_objects(self, object_type):
+        """Return every object of object_type from the snapshot cache
+
+        Returns None when the cache is disabled, callers then query the server.
+        """
+        if self._snapshots is None or object_type not in ZBX_SNAPSHOT_REQUESTS:
+            return None
+        try:
+            return self._snapshots.fetch(self._zapi, object_type)
+        except (IOError, OSError):
+            return None
+
+    def resolve_ids(self, object_type, names):
+        """Return a dict mapping names of object_type to ids, fail on unknown names"""
+        try:
+            return self._resolver.resolve(object_type, names)
+        except ZabbixResolveError as e:
+            self._module.fail_json(msg="Failed to resolve names: %s" % e)
+        except Exception as e:
+            self._module.fail_json(
+                msg="Failed to lookup %s %s: %s" % (object_type, ', '.join(names), e)
+            )
+
+    def logout(self):
+        """End the API session and drop it from the session cache
+
+        The session of an httpapi connection is ended by the plugin instead.
+        """
+        if self._zapi is None or not self._zapi.auth or self._httpapi:
+            return
+        try:
+            self._zapi.logout()
+        except Exception:
+            self._zapi.auth = ''
+        if self._session_cache is not None:
+            self._session_cache.clear()
@@ -4,7 +4,7 @@
 """Ansible module to manipulate global macros in Zabbix"""
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.zabbix import AnsibleZabbix, zbx_argument_spec
+from ansible.module_utils.zabbix import AnsibleZabbix, zbx_argument_spec, zbx_output
 
 
 DOCUMENTATION = '''
@@ -15,21 +15,23 @@ description:
    - manages Zabbix global macros, it can create, update or delete them.
 requirements:
     - "python >= 2.6"
-    - zabbix-api
 options:
     server_url:
         description:
             - Url of Zabbix server, with protocol (http or https).
-        required: true
+            - Not needed with the zabbix httpapi connection plugin.
+        required: false
         aliases: [ "url" ]
     login_user:
         description:
             - Zabbix user name.
-        required: true
+            - Not needed with the zabbix httpapi connection plugin.
+        required: false
     login_password:
         description:
             - Zabbix user password.
-        required: true
+            - Not needed with the zabbix httpapi connection plugin.
+        required: false
     http_login_user:
         description:
             - Basic Auth login
@@ -43,11 +45,29 @@ options:
     macro_name:
         description:
             - Name of the global macro.
-        required: true
+            - Required unless C(macros) is used.
+        required: false
     macro_value:
         description:
             - Value of the global macro.
-        required: true
+            - Required with C(macro_name) when state is C(present).
+        required: false
+    macros:
+        description:
+            - Dictionary of global macro names and values to manage in a
+              single task, mutually exclusive with C(macro_name).
+            - All global macros are read with one request and the changes
+              are sent as one batch of createglobal, updateglobal and
+              deleteglobal calls.
+            - On C(absent) the listed macros are removed, their values are
+              ignored.
+        required: false
+    exclusive:
+        description:
+            - With C(macros) and state C(present), also remove every global
+              macro that is not listed in C(macros).
+        required: false
+        default: false
     state:
         description:
             - State of the macro.
@@ -61,6 +81,113 @@ options:
         description:
             - The timeout of API request (seconds).
         default: 10
+    session_cache:
+        description:
+            - Reuse a previously authenticated API session for the same
+              server_url and credentials instead of logging in on every task.
+            - Sessions are stored under cache_dir on the host running the
+              module and checked with user.checkAuthentication before use.
+        required: false
+        default: true
+    cache_dir:
+        description:
+            - Directory holding the session cache.
+        required: false
+        default: "~/.ansible/zabbix"
+    logout:
+        description:
+            - Log out of the API session when the task finishes and remove it
+              from the session cache, typically set on the last Zabbix task of
+              a play.
+            - Forks still running with the session log in again once when the
+              server reports it as terminated.
+        required: false
+        default: false
+    debug:
+        description:
+            - Add a C(zbx_debug) key to the result with API client
+              diagnostics, such as HTTP connection reuse counters.
+            - Also repeats every get with output extend to report the
+              response bytes saved by requesting only the needed fields.
+        required: false
+        default: false
+    cache_ttl:
+        description:
+            - Seconds to keep snapshots of host groups, templates, user
+              groups and global macros under cache_dir, name lookups are
+              then answered from the snapshots.
+            - Writes made by these modules drop the snapshots they affect,
+              changes made elsewhere show up once the snapshot expires.
+            - C(0) disables the snapshots.
+        required: false
+        default: 0
+    retries:
+        description:
+            - Number of times a request is retried after a transient
+              failure, such as a timeout or an HTTP 502, 503 or 504.
+            - Reads are always retried, writes only when the server cannot
+              have processed them, for example when the connection was
+              refused or the frontend answered 503.
+        required: false
+        default: 3
+    retry_delay:
+        description:
+            - Base delay in seconds of the exponential backoff between
+              retries, each delay is randomized between zero and its
+              upper bound.
+        required: false
+        default: 0.5
+    retry_max_delay:
+        description:
+            - Upper bound in seconds of a single retry delay.
+        required: false
+        default: 10
+    circuit_threshold:
+        description:
+            - Consecutive calls failing with a transient error after their
+              retries, counted across all forks through cache_dir, after
+              which calls to server_url fail immediately for circuit_reset
+              seconds.
+            - C(0) disables the circuit breaker.
+        required: false
+        default: 5
+    circuit_reset:
+        description:
+            - Seconds to wait before trying a server again once the circuit
+              breaker opened.
+        required: false
+        default: 30
+    profile:
+        description:
+            - Add a C(zbx_timings) key to the result with the duration in
+              seconds of the login phase and of the whole module, and the
+              method, duration, request and response bytes of every API
+              call.
+            - The C(wait) of each call, and their total, is the time spent
+              waiting for rate_limit and max_concurrency.
+            - Calls that failed or timed out are listed with C(error) set.
+        required: false
+        default: false
+    rate_limit:
+        description:
+            - Maximum API requests per second sent to server_url, shared by
+              all forks on the controller through cache_dir.
+            - C(0) disables the rate limit.
+        required: false
+        default: 0
+    rate_burst:
+        description:
+            - Number of requests that may be sent at once before
+              rate_limit applies.
+        required: false
+        default: 10
+    max_concurrency:
+        description:
+            - Maximum API requests in flight to server_url at the same
+              time, across all forks on the controller.
+            - C(0) disables the cap.
+        required: false
+        default: 0
 '''
 
 EXAMPLES = '''
@@ -73,6 +200,25 @@ EXAMPLES = '''
     macro_name: foo
     macro_value: bar
     state: present
+
+- name: Make the listed macros the only global macros
+  local_action:
+    module: zabbix_globalmacro
+    server_url: http://monitor.example.com
+    login_user: username
+    login_password: password
+    macros:
+      foo: bar
+      snmp_community: public
+    exclusive: yes
+
+# With ansible_connection=httpapi, ansible_network_os=zabbix, ansible_user
+# and ansible_httpapi_pass set for the Zabbix server in the inventory, the
+# play logs in once and every task reuses the session
+- name: Set a global macro over the persistent connection
+  zabbix_globalmacro:
+    macro_name: foo
+    macro_value: bar
 '''
 
 class GlobalMacro(AnsibleZabbix):
@@ -83,10 +229,13 @@ class GlobalMacro(AnsibleZabbix):
 
     def get_global_macro(self, macro_name):
         """get global macro"""
+        for global_macro in self.cached_objects('usermacro') or []:
+            if global_macro['macro'] == '{$' + macro_name + '}':
+                return global_macro
         try:
             global_macro_list = self._zapi.usermacro.get({
                 "globalmacro": True,
-                "output": "extend",
+                'output': zbx_output('usermacro'),
                 'filter': {
                     'macro': '{$' + macro_name + '}'
                 }
@@ -152,22 +301,105 @@ class GlobalMacro(AnsibleZabbix):
         except Exception as e:
             self._module.fail_json(msg="Failed to delete global macro %s: %s" % (macro_name, e))
 
+    def sync_global_macros(self, macros, state, exclusive):
+        """create, update or delete global macros with batched requests"""
+        try:
+            global_macro_list = self.cached_objects('usermacro')
+            if global_macro_list is None:
+                global_macro_list = self._zapi.usermacro.get({
+                    "globalmacro": True,
+                    'output': zbx_output('usermacro')
+                })
+        except Exception as e:
+            self._module.fail_json(msg="Failed to get global macros: %s" % e)
+        existing = dict([
+            (global_macro['macro'], global_macro) for global_macro in global_macro_list
+        ])
+        desired = dict([
+            ('{$' + macro_name.upper() + '}', macro_value)
+            for macro_name, macro_value in macros.items()
+        ])
+
+        creates = []
+        updates = []
+        deletes = []
+        changes = {}
+        for macro, macro_value in sorted(desired.items()):
+            global_macro_obj = existing.get(macro)
+            if state == 'absent':
+                if global_macro_obj:
+                    deletes.append(global_macro_obj['globalmacroid'])
+                    changes[macro] = 'deleted'
+            elif not global_macro_obj:
+                creates.append({'macro': macro, 'value': macro_value})
+                changes[macro] = 'created'
+            elif global_macro_obj['value'] != macro_value:
+                updates.append({
+                    'globalmacroid': global_macro_obj['globalmacroid'],
+                    'value': macro_value
+                })
+                changes[macro] = 'updated'
+        if state == 'present' and exclusive:
+            for macro, global_macro_obj in sorted(existing.items()):
+                if macro not in desired:
+                    deletes.append(global_macro_obj['globalmacroid'])
+                    changes[macro] = 'deleted'
+
+        if not changes:
+            self._module.exit_json(changed=False, macros=changes)
+        if self._module.check_mode:
+            self._module.exit_json(changed=True, macros=changes)
+        batch = self.batch()
+        if creates:
+            batch.usermacro.createglobal(creates)
+        if updates:
+            batch.usermacro.updateglobal(updates)
+        if deletes:
+            batch.usermacro.deleteglobal(deletes)
+        try:
+            batch.send()
+        except Exception as e:
+            self._module.fail_json(
+                msg="Failed to update global macros: %s" % e, macros=changes
+            )
+        self._module.exit_json(
+            changed=True,
+            macros=changes,
+            result="Successfully synchronized %d global macros" % len(changes)
+        )
+
 def main():
     """Do the needful"""
     argument_spec = zbx_argument_spec()
     argument_spec.update(dict(
-        macro_name=dict(type='str', required=True),
-        macro_value=dict(type='str', required=True),
+        macro_name=dict(type='str', required=False, default=None),
+        macro_value=dict(type='str', required=False, default=None),
+        macros=dict(type='dict', required=False, default=None),
+        exclusive=dict(type='bool', required=False, default=False),
         state=dict(default="present", choices=['present', 'absent']),
     ))
     module = AnsibleModule(
         argument_spec=argument_spec,
+        mutually_exclusive=[['macro_name', 'macros']],
+        required_one_of=[['macro_name', 'macros']],
         supports_check_mode=True
     )
 
+    state = module.params['state']
+    macros = module.params['macros']
+    if macros is not None:
+        macros = dict([
+            (macro_name, '' if macro_value is None else str(macro_value))
+            for macro_name, macro_value in macros.items()
+        ])
+        GlobalMacro(module).sync_global_macros(
+            macros, state, module.params['exclusive']
+        )
+
     macro_name = (module.params['macro_name']).upper()
     macro_value = module.params['macro_value']
-    state = module.params['state']
+    if state == 'present' and macro_value is None:
+        module.fail_json(msg="macro_value is a required parameter on present")
 
     global_macro_class_obj = GlobalMacro(module)
 
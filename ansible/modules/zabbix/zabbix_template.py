@@ -3,8 +3,22 @@
 
 """Ansible module to manipulate Templates in Zabbix"""
 
+import codecs
+import glob
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from multiprocessing.pool import ThreadPool
+
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.zabbix import AnsibleZabbix, zbx_argument_spec
+from ansible.module_utils.zabbix import AnsibleZabbix, zbx_argument_spec, zbx_output
+from ansible.module_utils.zabbix import ZabbixStreamedString, zbx_file_lock, zbx_state_file
 
 
 DOCUMENTATION = '''
@@ -13,23 +27,31 @@ module: zabbix_template
 short_description: Zabbix Template import/update/delete
 description:
    - manages Zabbix Templates, it can import, update or delete them.
+   - Concurrent imports of the same file content to the same server,
+     such as from several forks of a play, are serialized with a lock under
+     cache_dir. Only the first import is sent, the other tasks reuse its
+     result and return C(coalesced).
+   - Template files are streamed to the server and the peak memory of the
+     module is returned in C(peak_memory_kb).
 requirements:
     - "python >= 2.6"
-    - zabbix-api
 options:
     server_url:
         description:
             - Url of Zabbix server, with protocol (http or https).
-        required: true
+            - Not needed with the zabbix httpapi connection plugin.
+        required: false
         aliases: [ "url" ]
     login_user:
         description:
             - Zabbix user name.
-        required: true
+            - Not needed with the zabbix httpapi connection plugin.
+        required: false
     login_password:
         description:
             - Zabbix user password.
-        required: true
+            - Not needed with the zabbix httpapi connection plugin.
+        required: false
     http_login_user:
         description:
             - Basic Auth login
@@ -46,12 +68,78 @@ options:
         required: false
     template_file:
         description:
-            - the xml file containing the template
+            - the xml or json export file containing the template
+            - The format is detected from the content and gzip compressed
+              files, such as C(.xml.gz) or C(.json.gz), are decompressed
+              while they are sent.
+        required: false
+    template_files:
+        description:
+            - List of export files or glob patterns of export files to
+              import, mutually exclusive with template_file
+            - Files may be in any format template_file accepts
+            - Templates linked to templates of another file in the list are
+              imported after that file, files that do not depend on each
+              other are imported concurrently
+        required: false
+    workers:
+        description:
+            - Maximum number of concurrent imports with template_files
         required: false
+        default: 4
     rename:
         description:
             - Change the name of an existing template
         required: false
+    template_names:
+        description:
+            - List of templates to delete in a single task when state is
+              C(absent), mutually exclusive with C(template_name).
+            - All templates are looked up with one request and deleted with
+              one template.delete call, templates before the templates they
+              link to.
+        required: false
+    renames:
+        description:
+            - Dictionary of current and new template names to rename in a
+              single task, mutually exclusive with C(template_name).
+            - Templates that do not exist are skipped, the others are renamed
+              with one template.update call.
+        required: false
+    validate:
+        description:
+            - Check that template files are well-formed exports of a
+              supported version without duplicate item keys before
+              connecting to the server.
+            - Templates linked from the files must either be defined in them
+              or exist on the server, regardless of this option.
+        required: false
+        default: true
+    sections:
+        description:
+            - Only apply the import rules of these sections, for example
+              C(items) and C(triggers), so the server does not compare the
+              other elements of the templates.
+            - Valid sections are applications, discoveryRules, graphs,
+              groups, httptests, items, templateLinkage, templates,
+              templateScreens and triggers. C(templates) is always applied.
+            - The digest of a file depends on the sections, a later import
+              with other sections is not skipped.
+            - The round trip of the import request in seconds, as seen by the
+              module and without rate_limit waits, is returned in
+              C(import_time), or C(import_times) per file with
+              template_files. It includes retries and sending the file.
+        required: false
+    force:
+        description:
+            - Import template_file or template_files even if the templates on the server were
+              imported from identical content.
+            - Without it, a digest of the file, ignoring its export date, is
+              stored in the C({$ANSIBLE_TEMPLATE_DIGEST}) macro of every
+              imported template and the import is skipped when all templates
+              of the file already carry the same digest.
+        required: false
+        default: false
     state:
         description:
             - State of the template
@@ -64,6 +152,113 @@ options:
         description:
             - The timeout of API request (seconds).
         default: 10
+    session_cache:
+        description:
+            - Reuse a previously authenticated API session for the same
+              server_url and credentials instead of logging in on every task.
+            - Sessions are stored under cache_dir on the host running the
+              module and checked with user.checkAuthentication before use.
+        required: false
+        default: true
+    cache_dir:
+        description:
+            - Directory holding the session cache.
+        required: false
+        default: "~/.ansible/zabbix"
+    logout:
+        description:
+            - Log out of the API session when the task finishes and remove it
+              from the session cache, typically set on the last Zabbix task of
+              a play.
+            - Forks still running with the session log in again once when the
+              server reports it as terminated.
+        required: false
+        default: false
+    debug:
+        description:
+            - Add a C(zbx_debug) key to the result with API client
+              diagnostics, such as HTTP connection reuse counters.
+            - Also repeats every get with output extend to report the
+              response bytes saved by requesting only the needed fields.
+        required: false
+        default: false
+    cache_ttl:
+        description:
+            - Seconds to keep snapshots of host groups, templates, user
+              groups and global macros under cache_dir, name lookups are
+              then answered from the snapshots.
+            - Writes made by these modules drop the snapshots they affect,
+              changes made elsewhere show up once the snapshot expires.
+            - C(0) disables the snapshots.
+        required: false
+        default: 0
+    retries:
+        description:
+            - Number of times a request is retried after a transient
+              failure, such as a timeout or an HTTP 502, 503 or 504.
+            - Reads are always retried, writes only when the server cannot
+              have processed them, for example when the connection was
+              refused or the frontend answered 503.
+        required: false
+        default: 3
+    retry_delay:
+        description:
+            - Base delay in seconds of the exponential backoff between
+              retries, each delay is randomized between zero and its
+              upper bound.
+        required: false
+        default: 0.5
+    retry_max_delay:
+        description:
+            - Upper bound in seconds of a single retry delay.
+        required: false
+        default: 10
+    circuit_threshold:
+        description:
+            - Consecutive calls failing with a transient error after their
+              retries, counted across all forks through cache_dir, after
+              which calls to server_url fail immediately for circuit_reset
+              seconds.
+            - C(0) disables the circuit breaker.
+        required: false
+        default: 5
+    circuit_reset:
+        description:
+            - Seconds to wait before trying a server again once the circuit
+              breaker opened.
+        required: false
+        default: 30
+    profile:
+        description:
+            - Add a C(zbx_timings) key to the result with the duration in
+              seconds of the login phase and of the whole module, and the
+              method, duration, request and response bytes of every API
+              call.
+            - The C(wait) of each call, and their total, is the time spent
+              waiting for rate_limit and max_concurrency.
+            - Calls that failed or timed out are listed with C(error) set.
+        required: false
+        default: false
+    rate_limit:
+        description:
+            - Maximum API requests per second sent to server_url, shared by
+              all forks on the controller through cache_dir.
+            - C(0) disables the rate limit.
+        required: false
+        default: 0
+    rate_burst:
+        description:
+            - Number of requests that may be sent at once before
+              rate_limit applies.
+        required: false
+        default: 10
+    max_concurrency:
+        description:
+            - Maximum API requests in flight to server_url at the same
+              time, across all forks on the controller.
+            - C(0) disables the cap.
+        required: false
+        default: 0
 '''
 
 EXAMPLES = '''
@@ -75,19 +270,525 @@ EXAMPLES = '''
     login_password: password
     template_file: zbx_foo.xml
     state: present
+
+- name: Import a directory of Templates that link to each other
+  local_action:
+    module: zabbix_template
+    server_url: http://monitor.example.com
+    login_user: username
+    login_password: password
+    template_files:
+      - templates/*.xml
+    workers: 8
+
+- name: Delete several Templates
+  local_action:
+    module: zabbix_template
+    server_url: http://monitor.example.com
+    login_user: username
+    login_password: password
+    template_names:
+      - Template Legacy Base
+      - Template Legacy App
+    state: absent
+
+- name: Rename several Templates
+  local_action:
+    module: zabbix_template
+    server_url: http://monitor.example.com
+    login_user: username
+    login_password: password
+    renames:
+      Template Foo: Template Foo Legacy
+      Template Bar: Template Bar Legacy
+
+- name: Only update the items and triggers of a Template
+  local_action:
+    module: zabbix_template
+    server_url: http://monitor.example.com
+    login_user: username
+    login_password: password
+    template_file: zbx_foo.xml
+    sections:
+      - items
+      - triggers
 '''
 
+# Template macro recording the digest of the file a template was imported from
+DIGEST_MACRO = '{$ANSIBLE_TEMPLATE_DIGEST}'
+
+IMPORT_RULES = {
+    'applications': {
+        'createMissing' : True,
+        'updateExisting': True,
+        'deleteMissing' : True,
+    },
+    'discoveryRules': {
+        'createMissing' : True,
+        'updateExisting': True,
+        'deleteMissing' : True,
+    },
+    'graphs': {
+        'createMissing' : True,
+        'updateExisting': True,
+        'deleteMissing' : True,
+    },
+    'groups': {
+        'createMissing' : True,
+    },
+    'httptests': {
+        'createMissing' : True,
+        'updateExisting' : True,
+        'deleteMissing' : True,
+    },
+    'items': {
+        'createMissing' : True,
+        'updateExisting': True,
+        'deleteMissing' : True,
+    },
+    'templateLinkage': {
+        'createMissing' : True,
+    },
+    'templates': {
+        'createMissing' : True,
+        'updateExisting': True,
+    },
+    'templateScreens': {
+        'createMissing' : True,
+        'updateExisting': True,
+        'deleteMissing' : True,
+    },
+    'triggers': {
+        'createMissing' : True,
+        'updateExisting': True,
+        'deleteMissing' : True,
+    }
+}
+
+# Export versions configuration.import understands
+SUPPORTED_VERSIONS = ('2.0', '3.0', '3.2', '3.4', '4.0', '4.2', '4.4', '5.0', '5.2')
+
+TEMPLATE_PATH = ['zabbix_export', 'templates', 'template']
+
+# Keys sharing the item key namespace of a template, graph items and the
+# like refer to these keys and are not counted
+ITEM_KEY_PATHS = [
+    TEMPLATE_PATH + ['items', 'item', 'key'],
+    TEMPLATE_PATH + ['discovery_rules', 'discovery_rule', 'key'],
+    TEMPLATE_PATH + ['discovery_rules', 'discovery_rule', 'item_prototypes',
+                     'item_prototype', 'key'],
+]
+
+# Objects of JSON exports parsed member by member, every array is parsed
+# item by item and any other value is decoded as a whole
+JSON_TEMPLATE_PATH = ['zabbix_export', 'templates', '[]']
+JSON_OBJECT_PATHS = [
+    [],
+    ['zabbix_export'],
+    JSON_TEMPLATE_PATH,
+    JSON_TEMPLATE_PATH + ['discovery_rules', '[]'],
+]
+# Objects carrying a key in the item key namespace of a template
+JSON_ITEM_PATHS = [
+    JSON_TEMPLATE_PATH + ['items', '[]'],
+    JSON_TEMPLATE_PATH + ['discovery_rules', '[]', 'item_prototypes', '[]'],
+]
+
+JSON_SPACE = re.compile(r'[ \t\r\n]*')
+
+def import_rules(sections):
+    """Return the import rules restricted to sections, all of them for None"""
+    if sections is None:
+        return IMPORT_RULES
+    return dict([
+        (section, IMPORT_RULES[section])
+        for section in set(sections) | set(['templates'])
+    ])
+
+def open_template_file(template_file):
+    """Open a template export as a binary file, decompressing it if gzipped"""
+    with open(template_file, 'rb') as raw_file:
+        magic = raw_file.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(template_file, 'rb')
+    return open(template_file, 'rb')
+
+def template_format(template_file):
+    """Return json or xml depending on the first character of the export"""
+    source = open_template_file(template_file)
+    try:
+        head = source.read(1024)
+    finally:
+        source.close()
+    if head.startswith(codecs.BOM_UTF8):
+        head = head[len(codecs.BOM_UTF8):]
+    if head.lstrip()[:1] == b'{':
+        return 'json'
+    return 'xml'
+
+def peak_memory_kb():
+    """Return the peak resident memory of the module process in KiB"""
+    # ru_maxrss survives exec on Linux and may be the peak of the parent
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Reported in bytes instead of KiB
+        peak //= 1024
+    return peak
+
+def scan_template_file(template_file, importrules, validate=True):
+    """Return the format, canonical digest, template names and linked templates of a file
+
+    Files may be XML or JSON exports, optionally gzip compressed. The digest
+    covers the content of the file, except the export date, plus the import
+    rules. With validate, raise ValueError if the file is not a well-formed
+    export of a supported version or if a template repeats an item key.
+    """
+    file_format = template_format(template_file)
+    source = open_template_file(template_file)
+    try:
+        if file_format == 'json':
+            scan = scan_json_template(source, importrules, validate)
+        else:
+            scan = scan_xml_template(source, importrules, validate)
+    finally:
+        source.close()
+    scan['format'] = file_format
+    return scan
+
+class JsonReader(object):
+    """Reads the JSON document of a binary file a chunk at a time"""
+
+    def __init__(self, source, size=65536):
+        self._source = source
+        self._decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self._json = json.JSONDecoder()
+        self._size = size
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, size):
+        if self._eof:
+            return False
+        chunk = self._source.read(size)
+        self._eof = not chunk
+        self._buf = self._buf[self._pos:] + self._decoder.decode(chunk, self._eof)
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """Skip whitespace and return the next character, '' at the end"""
+        while True:
+            self._pos = JSON_SPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill(self._size):
+                return ''
+
+    def skip(self):
+        self._pos += 1
+
+    def value(self):
+        """Decode the value at the current position"""
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buf, self._pos)
+                # A number ending the buffer may continue in the next chunk
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            # Doubling the buffer keeps large values linear to decode
+            self._fill(max(self._size, len(self._buf) - self._pos))
+
+def json_events(reader):
+    """Yield (event, path, value) of a JsonReader, raise ValueError if malformed
+
+    event is start or end around the objects of JSON_OBJECT_PATHS and all
+    arrays, key or value, value the bracket, key or decoded value. path
+    lists the keys leading to the event with [] for array items and must
+    not be kept by the caller.
+    """
+    path = []
+    containers = []
+    expect = 'value'
+    while True:
+        char = reader.peek()
+        if not char:
+            break
+        if char in '}]':
+            opened = containers[-1] if containers else None
+            if (opened, char) not in (('{', '}'), ('[', ']')) or expect not in (
+                    'separator', 'key or end' if char == '}' else 'value or end'):
+                raise ValueError("unexpected %s" % char)
+            reader.skip()
+            containers.pop()
+            path.pop()
+            yield 'end', path, char
+            expect = 'separator' if containers else 'end'
+        elif char == ',':
+            if expect != 'separator':
+                raise ValueError("unexpected ,")
+            reader.skip()
+            expect = 'key' if containers[-1] == '{' else 'value'
+        elif char == ':':
+            if expect != ':':
+                raise ValueError("unexpected :")
+            reader.skip()
+            expect = 'value'
+        elif expect in ('key', 'key or end'):
+            if char != '"':
+                raise ValueError("expected a key, got %s" % char)
+            path[-1] = reader.value()
+            yield 'key', path, path[-1]
+            expect = ':'
+        elif expect in ('value', 'value or end'):
+            if char == '[' or (char == '{' and path in JSON_OBJECT_PATHS):
+                reader.skip()
+                yield 'start', path, char
+                containers.append(char)
+                path.append(None if char == '{' else '[]')
+                expect = 'key or end' if char == '{' else 'value or end'
+            else:
+                yield 'value', path, reader.value()
+                expect = 'separator' if containers else 'end'
+        else:
+            raise ValueError("unexpected %s" % char)
+    if expect != 'end':
+        raise ValueError("unexpected end of data")
+
+def scan_json_template(source, importrules, validate=True):
+    """scan_template_file for JSON exports, which are parsed as a stream"""
+    digest = hashlib.sha256()
+    digest.update(json.dumps(importrules, sort_keys=True).encode('utf-8'))
+    template_names = []
+    linked_names = []
+    version = None
+    exported = False
+    item_keys = set()
+    duplicates = []
+    errors = []
+    hashed = []
+    try:
+        for event, path, value in json_events(JsonReader(source)):
+            if path[:2] == ['zabbix_export', 'date']:
+                continue
+            # Hashed in batches, the events in order describe the document
+            hashed.append(json.dumps(value, sort_keys=True) if event == 'value' else
+                          json.dumps(value) if event == 'key' else value)
+            if len(hashed) >= 4096:
+                digest.update(('\n'.join(hashed) + '\n').encode('utf-8'))
+                hashed = []
+            if event == 'start':
+                if path == ['zabbix_export']:
+                    exported = value == '{'
+                elif path == JSON_TEMPLATE_PATH:
+                    item_keys = set()
+                    duplicates = []
+            elif event == 'end' and path == JSON_TEMPLATE_PATH:
+                errors.extend([
+                    "duplicate item key %s in template %s" % (
+                        key, template_names[-1] if template_names else '?'
+                    )
+                    for key in duplicates
+                ])
+            elif event == 'value':
+                key = None
+                if path == ['zabbix_export', 'version']:
+                    version = value
+                elif path == JSON_TEMPLATE_PATH + ['template']:
+                    template_names.append(value)
+                elif path == JSON_TEMPLATE_PATH + ['templates', '[]']:
+                    if isinstance(value, dict):
+                        linked_names.append(value.get('name'))
+                elif path == JSON_TEMPLATE_PATH + ['discovery_rules', '[]', 'key']:
+                    key = value
+                elif path in JSON_ITEM_PATHS and isinstance(value, dict):
+                    key = value.get('key')
+                if key is not None:
+                    if key in item_keys:
+                        duplicates.append(key)
+                    item_keys.add(key)
+    except ValueError as e:
+        raise ValueError("not well-formed: %s" % e)
+    digest.update(('\n'.join(hashed) + '\n').encode('utf-8'))
+    if not exported:
+        if validate:
+            raise ValueError("root element is not zabbix_export")
+        template_names, linked_names = [], []
+    if validate:
+        if version not in SUPPORTED_VERSIONS:
+            errors.insert(0, "unsupported export version %s" % version)
+        if errors:
+            raise ValueError('; '.join(errors))
+    return dict(
+        digest=digest.hexdigest(),
+        templates=template_names,
+        linked=linked_names,
+    )
+
+def scan_xml_template(source, importrules, validate=True):
+    """scan_template_file for XML exports, which are parsed as a stream"""
+    digest = hashlib.sha256()
+    digest.update(json.dumps(importrules, sort_keys=True).encode('utf-8'))
+    template_names = []
+    linked_names = []
+    version = None
+    item_keys = set()
+    errors = []
+    path = []
+    skip_depth = None
+    try:
+        for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                path.append(elem.tag)
+                if skip_depth is None and path == ['zabbix_export', 'date']:
+                    skip_depth = len(path)
+                if skip_depth is None:
+                    digest.update(('<%s %s>' % (
+                        elem.tag, json.dumps(sorted(elem.attrib.items()))
+                    )).encode('utf-8'))
+                if path == TEMPLATE_PATH:
+                    item_keys = set()
+                continue
+            if skip_depth is None:
+                text = (elem.text or '').strip()
+                digest.update(('%s</%s>' % (json.dumps(text), elem.tag)).encode('utf-8'))
+                if path == ['zabbix_export', 'version']:
+                    version = text
+                elif path == TEMPLATE_PATH + ['template']:
+                    template_names.append(text)
+                elif path == TEMPLATE_PATH + ['templates', 'template', 'name']:
+                    linked_names.append(text)
+                elif path in ITEM_KEY_PATHS:
+                    if text in item_keys:
+                        errors.append("duplicate item key %s in template %s" % (
+                            text, template_names[-1] if template_names else '?'
+                        ))
+                    item_keys.add(text)
+            elif len(path) == skip_depth:
+                skip_depth = None
+            path.pop()
+            if len(path) > 1:
+                elem.clear()
+    except ElementTree.ParseError as e:
+        raise ValueError("not well-formed: %s" % e)
+    if validate:
+        if elem.tag != 'zabbix_export':
+            errors.insert(0, "root element is %s, not zabbix_export" % elem.tag)
+        elif version not in SUPPORTED_VERSIONS:
+            errors.insert(0, "unsupported export version %s" % version)
+        if errors:
+            raise ValueError('; '.join(errors))
+    return dict(
+        digest=digest.hexdigest(),
+        templates=template_names,
+        linked=linked_names,
+    )
+
+def scan_template_files(module, template_files):
+    """Scan and validate template files without contacting the server"""
+    scans = []
+    errors = []
+    for template_file in template_files:
+        try:
+            scans.append((template_file, scan_template_file(
+                template_file, import_rules(module.params['sections']),
+                module.params['validate']
+            )))
+        except Exception as e:
+            errors.append("%s: %s" % (template_file, e))
+    if errors:
+        module.fail_json(msg="Invalid template files: %s" % '; '.join(errors))
+    return scans
+
+def scan_digests(scans):
+    """Return the digest of every template of scanned files, keyed by name"""
+    return dict([
+        (name, scan['digest']) for scan in scans for name in scan['templates']
+    ])
+
+def delete_order(templates):
+    """Return the ids of templates, each before the templates it links to"""
+    ids = set([template['templateid'] for template in templates])
+    linked_by = dict([(templateid, set()) for templateid in ids])
+    for template in templates:
+        for parent in template.get('parentTemplates', []):
+            if parent['templateid'] in ids:
+                linked_by[parent['templateid']].add(template['templateid'])
+    layers = import_layers(linked_by) or [sorted(ids)]
+    return [templateid for layer in layers for templateid in layer]
+
+def expand_template_files(patterns):
+    """Return the files matching a list of paths and glob patterns"""
+    template_files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        for match in matches:
+            if match not in template_files:
+                template_files.append(match)
+    return template_files
+
+def import_layers(dependencies):
+    """Group files into layers where each file only depends on earlier layers
+
+    dependencies maps each file to the set of files it depends on, returns
+    None if they contain a cycle.
+    """
+    remaining = dict([(key, set(deps)) for key, deps in dependencies.items()])
+    layers = []
+    while remaining:
+        layer = sorted([key for key, deps in remaining.items() if not deps])
+        if not layer:
+            return None
+        layers.append(layer)
+        for key in layer:
+            del remaining[key]
+        for deps in remaining.values():
+            deps.difference_update(layer)
+    return layers
+
 class Template(AnsibleZabbix):
     """Return a Template object"""
     def __init__(self, module):
         super(Template, self).__init__(module)
+        self._checked_at = None
+        self._rules = import_rules(module.params['sections'])
+        self._import_times = {}
+        # Duration of the last configuration.import of each worker thread
+        self._import_call = threading.local()
+        self._zapi.hooks.append(self._record_import)
+
+    def _record_import(self, method, duration, *args):
+        if method == 'configuration.import':
+            self._import_call.duration = duration
+
+    def _on_exit(self, result):
+        super(Template, self)._on_exit(result)
+        result['peak_memory_kb'] = peak_memory_kb()
 
 
     def get_template(self, template_name):
         """get template"""
+        for template in self.cached_objects('template') or []:
+            if template['host'] == template_name:
+                return template
         try:
             template_list = self._zapi.template.get({
-                "output": "extend",
+                'output': zbx_output('template'),
                 'filter': {
                     'host': template_name
                 }
@@ -99,75 +800,253 @@ class Template(AnsibleZabbix):
             self._module.fail_json(msg="Failed to get Template %s: %s" % (template_name, e))
 
 
-    def import_template(self, template_file):
-        """import template"""
+    def get_templates(self, template_names, parents=False):
+        """get the existing templates of template_names with one request"""
+        request = {
+            'output': zbx_output('template'),
+            'filter': {
+                'host': template_names
+            }
+        }
+        if parents:
+            request['selectParentTemplates'] = ['templateid']
+        try:
+            return self._zapi.template.get(request)
+        except Exception as e:
+            self._module.fail_json(
+                msg="Failed to get Templates %s: %s" % (', '.join(template_names), e)
+            )
+
+    def get_template_digests(self, template_names):
+        """get the recorded import digest of each template, keyed by name"""
         try:
-            with open(template_file, "r") as myfile:
-                config = myfile.read()
-        except:
-            self.module.fail_json(
-                msg="failed to read template file: %s" % self.template_file
+            return self._template_digests(template_names)
+        except Exception as e:
+            self._module.fail_json(
+                msg="Failed to get Templates %s: %s" % (', '.join(template_names), e)
             )
 
-        importrules = {
-            'applications': {
-                'createMissing' : True,
-                'updateExisting': True,
-                'deleteMissing' : True,
-            },
-            'discoveryRules': {
-                'createMissing' : True,
-                'updateExisting': True,
-                'deleteMissing' : True,
-            },
-            'graphs': {
-                'createMissing' : True,
-                'updateExisting': True,
-                'deleteMissing' : True,
-            },
-            'groups': {
-                'createMissing' : True,
-            },
-            'httptests': {
-                'createMissing' : True,
-                'updateExisting' : True,
-                'deleteMissing' : True,
-            },
-            'items': {
-                'createMissing' : True,
-                'updateExisting': True,
-                'deleteMissing' : True,
-            },
-            'templateLinkage': {
-                'createMissing' : True,
-            },
-            'templates': {
-                'createMissing' : True,
-                'updateExisting': True,
-            },
-            'templateScreens': {
-                'createMissing' : True,
-                'updateExisting': True,
-                'deleteMissing' : True,
-            },
-            'triggers': {
-                'createMissing' : True,
-                'updateExisting': True,
-                'deleteMissing' : True,
+    def _template_digests(self, template_names):
+        """get_template_digests raising on failure, safe in worker threads"""
+        template_list = self._zapi.template.get({
+            'output': zbx_output('template'),
+            'selectMacros': zbx_output('hostmacro'),
+            'filter': {
+                'host': template_names
             }
+        })
+        digests = {}
+        for template in template_list:
+            digests[template['host']] = dict(templateid=template['templateid'])
+            for macro in template.get('macros', []):
+                if macro['macro'] == DIGEST_MACRO:
+                    digests[template['host']].update(macro)
+        return digests
+
+    def set_template_digests(self, digests):
+        """record the digests of a dict keyed by template name in their digest macros
+
+        All templates are read with one request and their macros written with
+        one batch of a usermacro.create and a usermacro.update.
+        """
+        if not digests:
+            return
+        creates = []
+        updates = []
+        for name, template in sorted(self._template_digests(sorted(digests)).items()):
+            digest = digests[name]
+            if 'hostmacroid' not in template:
+                creates.append({
+                    'hostid': template['templateid'],
+                    'macro': DIGEST_MACRO,
+                    'value': digest
+                })
+            elif template['value'] != digest:
+                updates.append({
+                    'hostmacroid': template['hostmacroid'],
+                    'value': digest
+                })
+        batch = self.batch()
+        if creates:
+            batch.usermacro.create(creates)
+        if updates:
+            batch.usermacro.update(updates)
+        batch.send()
+
+    def up_to_date(self, scan, digests):
+        """check if every template of a scanned file carries its digest"""
+        return bool(scan['templates']) and all([
+            digests.get(name, {}).get('value') == scan['digest']
+            for name in scan['templates']
+        ])
+
+    def _import_file(self, template_file, scan, record=True):
+        """import a scanned template file unless another fork just did
+
+        Imports of the same content to the same server are serialized with a
+        controller-local lock. A fork that waited for the lock reuses the
+        result the ledger recorded since it checked the digests, and returns
+        False instead of importing again. Without record the caller records
+        the digests of the file.
+        """
+        ledger_path = zbx_state_file(
+            self._module.params['cache_dir'], 'imports',
+            self._endpoint, scan['digest']
+        )
+        with zbx_file_lock(ledger_path + '.lock'):
+            try:
+                with open(ledger_path, 'r') as ledger_file:
+                    entry = json.load(ledger_file)
+            except (IOError, OSError, ValueError):
+                entry = {}
+            if self._checked_at is not None and entry.get('finished', 0) >= self._checked_at:
+                if entry.get('error'):
+                    raise Exception("concurrent import failed: %s" % entry['error'])
+                return False
+            error = None
+            try:
+                self._upload_file(template_file, scan, record)
+            except Exception as e:
+                error = str(e)
+            tmp_path = '%s.%d' % (ledger_path, os.getpid())
+            with open(tmp_path, 'w') as ledger_file:
+                json.dump({'finished': time.time(), 'error': error}, ledger_file)
+            os.rename(tmp_path, ledger_path)
+            if error is not None:
+                raise Exception(error)
+        return True
+
+    def _upload_file(self, template_file, scan, record=True):
+        """import a scanned template file and, with record, record its digest"""
+        # Streamed from the file, decompressed on the fly, as it is sent
+        parameters = {
+            'format': scan['format'],
+            'source': ZabbixStreamedString(lambda: open_template_file(template_file)),
+            'rules': self._rules,
         }
-        parameters = {'format': 'xml', 'source': config, 'rules': importrules}
+        self._zapi.configuration.import_(parameters)
+        self._import_times[template_file] = round(self._import_call.duration, 4)
+        if record:
+            self.set_template_digests(scan_digests([scan]))
+
+    def check_templates(self, scans):
+        """get the digests of scanned templates, fail if a linked template is missing
+
+        Templates linked from the files but not defined in them are looked up
+        in the same request.
+        """
+        owned = set([name for _, scan in scans for name in scan['templates']])
+        linked = set([name for _, scan in scans for name in scan['linked']]) - owned
+        template_names = set(linked)
+        if not self._module.params['force']:
+            template_names.update(owned)
+        self._checked_at = time.time()
+        if not template_names:
+            return {}
+        digests = self.get_template_digests(sorted(template_names))
+        missing = sorted(linked - set(digests))
+        if missing:
+            self._module.fail_json(
+                msg="Linked templates not found: %s" % ', '.join(missing)
+            )
+        return digests
+
+    def import_template(self, template_file, scan):
+        """import template"""
+        digest = scan['digest']
+
+        digests = self.check_templates([(template_file, scan)])
+        if not self._module.params['force'] and self.up_to_date(scan, digests):
+            self._module.exit_json(
+                changed=False,
+                digest=digest,
+                result="Templates %s already up to date" % ', '.join(scan['templates'])
+            )
+
         try:
             if self._module.check_mode:
-                self._module.exit_json(changed=True)
-            self._zapi.configuration.import_(parameters)
+                self._module.exit_json(changed=True, digest=digest)
+            imported = self._import_file(template_file, scan)
             self._module.exit_json(
                 changed=True,
+                digest=digest,
+                coalesced=not imported,
+                import_time=self._import_times.get(template_file),
                 result="Successfully imported template"
             )
         except Exception as e:
             self._module.fail_json(msg="Failed to import template: %s" % e)
 
+    def import_templates(self, template_scans):
+        """import template files in dependency order, concurrently where possible"""
+        template_files = [template_file for template_file, _ in template_scans]
+        scans = dict(template_scans)
+        owners = {}
+        for template_file, scan in template_scans:
+            for name in scan['templates']:
+                owners[name] = template_file
+
+        layers = import_layers(dict([
+            (template_file, set([
+                owners[name] for name in scan['linked']
+                if owners.get(name, template_file) != template_file
+            ]))
+            for template_file, scan in scans.items()
+        ]))
+        if layers is None:
+            self._module.fail_json(msg="Template files link to each other in a cycle")
+
+        pending = set(template_files)
+        digests = self.check_templates(template_scans)
+        if not self._module.params['force']:
+            pending = set([
+                template_file for template_file in template_files
+                if not self.up_to_date(scans[template_file], digests)
+            ])
+        results = dict([
+            (template_file, 'imported' if template_file in pending else 'unchanged')
+            for template_file in template_files
+        ])
+        if not pending or self._module.check_mode:
+            self._module.exit_json(changed=bool(pending), templates=results)
+
+        def import_one(template_file):
+            try:
+                imported = self._import_file(template_file, scans[template_file], False)
+                if not imported:
+                    results[template_file] = 'coalesced'
+                return imported, None
+            except Exception as e:
+                return False, "%s: %s" % (template_file, e)
+
+        pool = ThreadPool(max(1, min(self._module.params['workers'], len(pending))))
+        try:
+            for layer in layers:
+                layer = [f for f in layer if f in pending]
+                outcomes = pool.map(import_one, layer)
+                errors = [error for _, error in outcomes if error is not None]
+                # The digests of a layer are recorded at once, also when some
+                # of its files failed, so the next run skips the others
+                try:
+                    self.set_template_digests(scan_digests([
+                        scans[template_file]
+                        for template_file, (imported, _) in zip(layer, outcomes)
+                        if imported
+                    ]))
+                except Exception as e:
+                    errors.append("failed to record digests: %s" % e)
+                if errors:
+                    self._module.fail_json(
+                        msg="Failed to import templates: %s" % '; '.join(errors)
+                    )
+        finally:
+            pool.terminate()
+        self._module.exit_json(
+            changed=True,
+            templates=results,
+            import_times=self._import_times,
+            result="Successfully imported %d template files" % len(pending)
+        )
 
     def rename_template(self, template_obj, rename):
         """rename template"""
@@ -201,30 +1080,117 @@ class Template(AnsibleZabbix):
         except Exception as e:
             self._module.fail_json(msg="Failed to delete template %s: %s" % (template_name, e))
 
+    def rename_templates(self, renames):
+        """rename templates with one template.update call"""
+        existing = dict([
+            (template['host'], template)
+            for template in self.get_templates(sorted(renames))
+        ])
+        updates = []
+        changes = {}
+        for template_name, rename in sorted(renames.items()):
+            if template_name in existing and template_name != rename:
+                updates.append({
+                    'templateid': existing[template_name]['templateid'],
+                    'host': rename,
+                    'name': rename
+                })
+                changes[template_name] = rename
+        if not changes:
+            self._module.exit_json(changed=False, templates=changes)
+        if self._module.check_mode:
+            self._module.exit_json(changed=True, templates=changes)
+        try:
+            self._zapi.template.update(updates)
+        except Exception as e:
+            self._module.fail_json(msg="Failed to rename templates: %s" % e)
+        self._module.exit_json(
+            changed=True,
+            templates=changes,
+            result="Successfully renamed %d templates" % len(changes)
+        )
+
+    def delete_templates(self, template_names):
+        """delete templates with one template.delete call"""
+        templates = self.get_templates(template_names, parents=True)
+        deleted = sorted([template['host'] for template in templates])
+        if not deleted or self._module.check_mode:
+            self._module.exit_json(changed=bool(deleted), templates=deleted)
+        try:
+            self._zapi.template.delete(delete_order(templates))
+        except Exception as e:
+            self._module.fail_json(
+                msg="Failed to delete templates %s: %s" % (', '.join(deleted), e)
+            )
+        self._module.exit_json(
+            changed=True,
+            templates=deleted,
+            result="Successfully deleted %d templates" % len(deleted)
+        )
+
 def main():
     """Do the needful"""
     argument_spec = zbx_argument_spec()
     argument_spec.update(dict(
         template_file=dict(type='str', required=False, default=None),
+        template_files=dict(type='list', required=False, default=None),
+        workers=dict(type='int', required=False, default=4),
         template_name=dict(type='str', required=False, default=None),
         rename=dict(type='str', required=False, default=None),
+        template_names=dict(type='list', required=False, default=None),
+        renames=dict(type='dict', required=False, default=None),
+        validate=dict(type='bool', required=False, default=True),
+        sections=dict(type='list', required=False, default=None),
+        force=dict(type='bool', required=False, default=False),
         state=dict(default="present", choices=['present', 'absent']),
     ))
     module = AnsibleModule(
         argument_spec=argument_spec,
+        mutually_exclusive=[
+            ['template_file', 'template_files'],
+            ['template_name', 'template_names'],
+            ['template_name', 'renames'],
+        ],
         supports_check_mode=True
     )
 
+    sections = module.params.get('sections')
+    if sections is not None:
+        unknown = sorted(set(sections) - set(IMPORT_RULES))
+        if unknown:
+            module.fail_json(
+                msg="Unknown import rule sections: %s, valid sections are %s" % (
+                    ', '.join(unknown), ', '.join(sorted(IMPORT_RULES))
+                )
+            )
+
+    state = module.params.get('state')
+    template_file = module.params.get('template_file')
+    template_files = module.params.get('template_files')
+
+    # Reject invalid files before connecting to the server
+    template_scans = None
+    if state == 'present':
+        if template_file is not None:
+            template_scans = scan_template_files(module, [template_file])
+        elif template_files is not None:
+            template_scans = scan_template_files(
+                module, expand_template_files(template_files)
+            )
+
     try:
         template_class_obj = Template(module)
-        state = module.params.get('state')
-        template_file = module.params.get('template_file')
         template_name = module.params.get('template_name')
         rename = module.params.get('rename')
+        template_names = module.params.get('template_names')
+        renames = module.params.get('renames')
 
         if state == 'absent':
-            if template_name is None:
-                module.fail_json(msg="template_name is a required parameter on remove")
+            if template_names is not None:
+                # delete several templates
+                template_class_obj.delete_templates(template_names)
+            elif template_name is None:
+                module.fail_json(msg="template_name or template_names is required on remove")
             else:
                 template_obj = template_class_obj.get_template(template_name)
                 if not template_obj:
@@ -235,7 +1201,13 @@ def main():
         elif state == 'present':
             if template_file is not None:
                 # import template
-                template_class_obj.import_template(template_file)
+                template_class_obj.import_template(*template_scans[0])
+            elif template_files is not None:
+                # import several templates
+                template_class_obj.import_templates(template_scans)
+            elif renames is not None:
+                # rename several templates
+                template_class_obj.rename_templates(renames)
             elif (template_name is not None and rename is not None):
                 template_obj = template_class_obj.get_template(template_name)
                 if not template_obj:
@@ -245,7 +1217,9 @@ def main():
                     template_class_obj.rename_template(template_obj, rename)
             else:
                 # unknown operation
-                module.fail_json(msg="Either template_file or template_name must be set")
+                module.fail_json(
+                    msg="Either template_file, template_files, template_name or renames must be set"
+                )
         else:
             module.fail_json(msg="Unknown state: %s" % state)
 
@@ -4,7 +4,7 @@
 """Ansible module to manipulate users in Zabbix"""
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.zabbix import AnsibleZabbix, zbx_argument_spec
+from ansible.module_utils.zabbix import AnsibleZabbix, zbx_argument_spec, zbx_output
 
 
 DOCUMENTATION = '''
@@ -15,21 +15,23 @@ description:
    - manages Zabbix users, it can create, update or delete them.
 requirements:
     - "python >= 2.6"
-    - zabbix-api
 options:
     server_url:
         description:
             - Url of Zabbix server, with protocol (http or https).
-        required: true
+            - Not needed with the zabbix httpapi connection plugin.
+        required: false
         aliases: [ "url" ]
     login_user:
         description:
             - Zabbix api user name.
-        required: true
+            - Not needed with the zabbix httpapi connection plugin.
+        required: false
     login_password:
         description:
             - Zabbix api user password.
-        required: true
+            - Not needed with the zabbix httpapi connection plugin.
+        required: false
     http_login_user:
         description:
             - Basic Auth login
@@ -43,12 +45,21 @@ options:
     user_alias:
         description:
             - Login name of the user
-        required: true
+            - Required unless C(users) is used
+        required: false
     user_password:
         description:
             - Password to set for the user
             - Defaults to the same as their user_alias
         required: false
+    update_password:
+        description:
+            - C(on_create) only sets user_password when the user is created
+            - C(always) also sends it on every update, which always reports
+              a change since the current password cannot be compared
+        required: false
+        choices: ['always', 'on_create']
+        default: on_create
     user_groups:
         description:
             - Array of groups to add the user to
@@ -69,6 +80,18 @@ options:
             - 2 - Admin
             - 3 - Super Admin
         required: false
+    users:
+        description:
+            - List of users to manage in a single task, mutually exclusive
+              with C(user_alias)
+            - Each entry is a dictionary with the keys alias (required),
+              password, name, surname, type, groups and state, which take
+              the same values as the corresponding user_* options
+            - All users and groups are looked up with one request and the
+              changes are sent as one batch of user.create, user.update and
+              user.delete calls
+            - Passwords in this list are hidden from the task output
+        required: false
     state:
         description:
             - State of the user
@@ -81,6 +104,113 @@ options:
         description:
             - The timeout of API request (seconds).
         default: 10
+    session_cache:
+        description:
+            - Reuse a previously authenticated API session for the same
+              server_url and credentials instead of logging in on every task.
+            - Sessions are stored under cache_dir on the host running the
+              module and checked with user.checkAuthentication before use.
+        required: false
+        default: true
+    cache_dir:
+        description:
+            - Directory holding the session cache.
+        required: false
+        default: "~/.ansible/zabbix"
+    logout:
+        description:
+            - Log out of the API session when the task finishes and remove it
+              from the session cache, typically set on the last Zabbix task of
+              a play.
+            - Forks still running with the session log in again once when the
+              server reports it as terminated.
+        required: false
+        default: false
+    debug:
+        description:
+            - Add a C(zbx_debug) key to the result with API client
+              diagnostics, such as HTTP connection reuse counters.
+            - Also repeats every get with output extend to report the
+              response bytes saved by requesting only the needed fields.
+        required: false
+        default: false
+    cache_ttl:
+        description:
+            - Seconds to keep snapshots of host groups, templates, user
+              groups and global macros under cache_dir, name lookups are
+              then answered from the snapshots.
+            - Writes made by these modules drop the snapshots they affect,
+              changes made elsewhere show up once the snapshot expires.
+            - C(0) disables the snapshots.
+        required: false
+        default: 0
+    retries:
+        description:
+            - Number of times a request is retried after a transient
+              failure, such as a timeout or an HTTP 502, 503 or 504.
+            - Reads are always retried, writes only when the server cannot
+              have processed them, for example when the connection was
+              refused or the frontend answered 503.
+        required: false
+        default: 3
+    retry_delay:
+        description:
+            - Base delay in seconds of the exponential backoff between
+              retries, each delay is randomized between zero and its
+              upper bound.
+        required: false
+        default: 0.5
+    retry_max_delay:
+        description:
+            - Upper bound in seconds of a single retry delay.
+        required: false
+        default: 10
+    circuit_threshold:
+        description:
+            - Consecutive calls failing with a transient error after their
+              retries, counted across all forks through cache_dir, after
+              which calls to server_url fail immediately for circuit_reset
+              seconds.
+            - C(0) disables the circuit breaker.
+        required: false
+        default: 5
+    circuit_reset:
+        description:
+            - Seconds to wait before trying a server again once the circuit
+              breaker opened.
+        required: false
+        default: 30
+    profile:
+        description:
+            - Add a C(zbx_timings) key to the result with the duration in
+              seconds of the login phase and of the whole module, and the
+              method, duration, request and response bytes of every API
+              call.
+            - The C(wait) of each call, and their total, is the time spent
+              waiting for rate_limit and max_concurrency.
+            - Calls that failed or timed out are listed with C(error) set.
+        required: false
+        default: false
+    rate_limit:
+        description:
+            - Maximum API requests per second sent to server_url, shared by
+              all forks on the controller through cache_dir.
+            - C(0) disables the rate limit.
+        required: false
+        default: 0
+    rate_burst:
+        description:
+            - Number of requests that may be sent at once before
+              rate_limit applies.
+        required: false
+        default: 10
+    max_concurrency:
+        description:
+            - Maximum API requests in flight to server_url at the same
+              time, across all forks on the controller.
+            - C(0) disables the cap.
+        required: false
+        default: 0
 '''
 
 EXAMPLES = '''
@@ -94,55 +224,83 @@ EXAMPLES = '''
     user_name: Foo
     user_surname: Bar
     state: present
+
+- name: Create or update several users at once
+  local_action:
+    module: zabbix_user
+    server_url: http://monitor.example.com
+    login_user: username
+    login_password: password
+    users:
+      - alias: fbar
+        password: secret
+        name: Foo
+        surname: Bar
+        groups: ['Zabbix administrators']
+      - alias: olduser
+        state: absent
 '''
 
+USER_FIELDS = ('name', 'surname', 'type')
+USER_STATES = ('present', 'absent')
+
+def user_request(aliases):
+    """Return user.get parameters fetching the managed fields and groups"""
+    return {
+        'output': zbx_output('user'),
+        'selectUsrgrps': zbx_output('usrgrp'),
+        'filter': {
+            'alias': aliases
+        }
+    }
+
+def diff_user(user_obj, user_def):
+    """Return the fields of user_def that differ from the existing user_obj"""
+    changes = {}
+    for field in USER_FIELDS:
+        if field in user_def and str(user_def[field]) != str(user_obj.get(field)):
+            changes[field] = user_def[field]
+    if 'usrgrps' in user_def:
+        current = sorted([str(group['usrgrpid']) for group in user_obj.get('usrgrps', [])])
+        wanted = sorted([str(group['usrgrpid']) for group in user_def['usrgrps']])
+        if current != wanted:
+            changes['usrgrps'] = user_def['usrgrps']
+    if 'passwd' in user_def:
+        changes['passwd'] = user_def['passwd']
+    return changes
+
 class User(AnsibleZabbix):
     """Return a User object"""
     def __init__(self, module):
         super(User, self).__init__(module)
 
 
-    def get_user(self):
-        """get user"""
+    def lookup(self, group_names):
+        """get user and the ids of its groups in a single request"""
         user_alias = self._module.params['user_alias']
+        batch = self.batch()
+        self._resolver.queue(batch, 'usergroup', group_names)
+        user_call = batch.user.get(user_request(user_alias))
         try:
-            user_list = self._zapi.user.get({
-                "output": "extend",
-                'filter': {
-                    'alias': user_alias
-                }
-            })
-            if len(user_list) > 0:
-                return user_list[0]
-            return None
+            batch.send()
         except Exception as e:
             self._module.fail_json(
                 msg="Failed to get user %s: %s" % (user_alias, e)
             )
-
-    def get_group(self, group_name):
-        """get group"""
-        try:
-            group_list = self._zapi.usergroup.get({
-                'output': 'extend',
-                'filter': {
-                    'name': group_name
-                }
-            })
-            if len(group_list) > 0:
-                return group_list[0]
-            return None
-        except Exception as e:
-            self._module.fail_json(
-                msg="Failed to get group %s: %s" % (group_name, e)
-            )
+        group_ids = self.resolve_ids('usergroup', group_names)
+        user_group_ids = [{'usrgrpid': group_ids[name]} for name in group_names]
+        if len(user_call.result) > 0:
+            return user_group_ids, user_call.result[0]
+        return user_group_ids, None
 
     def create_user(self, user_group_ids):
         """create user"""
         params = self._module.params
         user_def=dict(
             alias=params['user_alias'],
-            usrgrps=user_group_ids or [{'usrgrpid': self.get_group('Guests')['usrgrpid']}]
+            usrgrps=user_group_ids or [
+                {'usrgrpid': self.resolve_ids('usergroup', ['Guests'])['Guests']}
+            ]
         )
         if params.get('user_password') is None:
             self._module.fail_json(
@@ -173,17 +331,27 @@ class User(AnsibleZabbix):
         """update user"""
         params = self._module.params
         user_alias = user_obj['alias']
-        user_def = dict(userid=user_obj['userid'])
+        user_def = {}
         if params.get('user_name') is not None:
             user_def['name'] = params['user_name']
         if params.get('user_surname') is not None:
             user_def['surname'] = params['user_surname']
         if params.get('user_type') is not None:
             user_def['type'] = params['user_type']
-        if params.get('user_password') is not None:
+        if (
+                params.get('user_password') is not None and
+                params['update_password'] == 'always'
+            ):
             user_def['passwd'] = params['user_password']
         if user_group_ids:
             user_def['usrgrps'] = user_group_ids
+        user_def = diff_user(user_obj, user_def)
+        if not user_def:
+            self._module.exit_json(
+                changed=False,
+                result="User %s already up to date" % user_alias
+            )
+        user_def['userid'] = user_obj['userid']
         try:
             if self._module.check_mode:
                 self._module.exit_json(changed=True)
@@ -197,6 +365,87 @@ class User(AnsibleZabbix):
                 msg="Failed to update user %s: %s" % (user_alias, e)
             )
 
+    def sync_users(self, users):
+        """create, update or delete a list of users with batched requests"""
+        aliases = [user['alias'] for user in users]
+        group_names = set()
+        for user in users:
+            group_names.update(user.get('groups') or [])
+            if user.get('state', 'present') == 'present' and not user.get('groups'):
+                group_names.add('Guests')
+
+        batch = self.batch()
+        self._resolver.queue(batch, 'usergroup', group_names)
+        user_call = batch.user.get(user_request(aliases))
+        try:
+            batch.send()
+        except Exception as e:
+            self._module.fail_json(msg="Failed to get users: %s" % e)
+
+        group_ids = self.resolve_ids('usergroup', group_names)
+        existing = dict([(user['alias'], user) for user in user_call.result])
+
+        creates = []
+        updates = []
+        deletes = []
+        changes = {}
+        for user in users:
+            alias = user['alias']
+            user_obj = existing.get(alias)
+            if user.get('state', 'present') == 'absent':
+                if user_obj:
+                    deletes.append(user_obj['userid'])
+                    changes[alias] = 'deleted'
+                continue
+            user_def = dict(
+                (field, user[field]) for field in USER_FIELDS
+                if user.get(field) is not None
+            )
+            if user.get('password') is not None:
+                user_def['passwd'] = user['password']
+            if user.get('groups'):
+                user_def['usrgrps'] = [
+                    {'usrgrpid': group_ids[name]} for name in user['groups']
+                ]
+            if user_obj:
+                if self._module.params['update_password'] != 'always':
+                    user_def.pop('passwd', None)
+                user_def = diff_user(user_obj, user_def)
+                if user_def:
+                    user_def['userid'] = user_obj['userid']
+                    updates.append(user_def)
+                    changes[alias] = 'updated'
+            else:
+                if user.get('password') is None:
+                    self._module.fail_json(
+                        msg='Failed to create user %s : password not defined' % alias
+                    )
+                user_def['alias'] = alias
+                if 'usrgrps' not in user_def:
+                    user_def['usrgrps'] = [{'usrgrpid': group_ids['Guests']}]
+                creates.append(user_def)
+                changes[alias] = 'created'
+
+        if not changes:
+            self._module.exit_json(changed=False, users=changes)
+        if self._module.check_mode:
+            self._module.exit_json(changed=True, users=changes)
+        if creates:
+            batch.user.create(creates)
+        if updates:
+            batch.user.update(updates)
+        if deletes:
+            batch.user.delete(deletes)
+        try:
+            batch.send()
+        except Exception as e:
+            self._module.fail_json(msg="Failed to update users: %s" % e, users=changes)
+        self._module.exit_json(
+            changed=True,
+            users=changes,
+            result="Successfully synchronized %d users" % len(changes)
+        )
+
     def delete_user(self, user_obj):
         """delete user"""
         user_id = user_obj['userid']
@@ -220,7 +469,8 @@ def main():
     argument_spec.update(dict(
         user_alias=dict(
             type='str',
-            required=True
+            required=False,
+            default=None
         ),
         user_password=dict(
             type='str',
@@ -244,11 +494,23 @@ def main():
             default=None,
             choices=[1, 2, 3]
         ),
+        update_password=dict(
+            type='str',
+            required=False,
+            no_log=False,
+            default='on_create',
+            choices=['always', 'on_create']
+        ),
         user_groups=dict(
             type='list',
             required=False,
             default=None
         ),
+        users=dict(
+            type='list',
+            required=False,
+            default=None
+        ),
         state=dict(
             default="present",
             choices=['present', 'absent']
@@ -256,20 +518,46 @@ def main():
     ))
     module = AnsibleModule(
         argument_spec=argument_spec,
+        mutually_exclusive=[['user_alias', 'users']],
+        required_one_of=[['user_alias', 'users']],
         supports_check_mode=True
     )
 
+    users = module.params['users']
+    if users is not None:
+        # Validate data structure
+        seen = set()
+        for user in users:
+            if isinstance(user, dict) and user.get('password'):
+                module.no_log_values.add(user['password'])
+            if not isinstance(user, dict) or user.get('alias') is None:
+                module.fail_json(msg="alias value for users is required")
+            if user['alias'] in seen:
+                module.fail_json(msg="User %s is listed more than once" % user['alias'])
+            seen.add(user['alias'])
+            if user.get('state', 'present') not in USER_STATES:
+                module.fail_json(
+                    msg="Value %s is not valid for user state" % user['state']
+                )
+            if user.get('type') is not None:
+                try:
+                    user['type'] = int(user['type'])
+                except (TypeError, ValueError):
+                    user['type'] = None
+                if user['type'] not in [1, 2, 3]:
+                    module.fail_json(
+                        msg="Type of user %s must be one of 1, 2, 3" % user['alias']
+                    )
+
     user_class_obj = User(module)
 
-    # Lookup and convert group names to ids
-    user_group_ids = []
-    if module.params.get('user_groups') is not None:
-        for group_name in module.params['user_groups']:
-            user_group_ids.append({
-                'usrgrpid': user_class_obj.get_group(group_name)['usrgrpid']
-            })
+    if users is not None:
+        user_class_obj.sync_users(users)
 
-    user_obj = user_class_obj.get_user()
+    # Lookup the user and convert group names to ids
+    user_group_ids, user_obj = user_class_obj.lookup(
+        module.params.get('user_groups') or []
+    )
 
     if module.params['state'] == 'absent':
         if not user_obj:
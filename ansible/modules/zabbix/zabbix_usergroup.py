@@ -4,7 +4,7 @@
 """Ansible module to manipulate groups in Zabbix"""
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.zabbix import AnsibleZabbix, zbx_argument_spec
+from ansible.module_utils.zabbix import AnsibleZabbix, zbx_argument_spec, zbx_output
 
 
 DOCUMENTATION = '''
@@ -15,21 +15,23 @@ description:
    - manages Zabbix groups, it can create, update or delete them.
 requirements:
     - "python >= 2.6"
-    - zabbix-api
 options:
     server_url:
         description:
             - Url of Zabbix server, with protocol (http or https).
-        required: true
+            - Not needed with the zabbix httpapi connection plugin.
+        required: false
         aliases: [ "url" ]
     login_user:
         description:
             - Zabbix api user name.
-        required: true
+            - Not needed with the zabbix httpapi connection plugin.
+        required: false
     login_password:
         description:
             - Zabbix api user password.
-        required: true
+            - Not needed with the zabbix httpapi connection plugin.
+        required: false
     http_login_user:
         description:
             - Basic Auth login
@@ -84,6 +86,113 @@ options:
         description:
             - The timeout of API request (seconds).
         default: 10
+    session_cache:
+        description:
+            - Reuse a previously authenticated API session for the same
+              server_url and credentials instead of logging in on every task.
+            - Sessions are stored under cache_dir on the host running the
+              module and checked with user.checkAuthentication before use.
+        required: false
+        default: true
+    cache_dir:
+        description:
+            - Directory holding the session cache.
+        required: false
+        default: "~/.ansible/zabbix"
+    logout:
+        description:
+            - Log out of the API session when the task finishes and remove it
+              from the session cache, typically set on the last Zabbix task of
+              a play.
+            - Forks still running with the session log in again once when the
+              server reports it as terminated.
+        required: false
+        default: false
+    debug:
+        description:
+            - Add a C(zbx_debug) key to the result with API client
+              diagnostics, such as HTTP connection reuse counters.
+            - Also repeats every get with output extend to report the
+              response bytes saved by requesting only the needed fields.
+        required: false
+        default: false
+    cache_ttl:
+        description:
+            - Seconds to keep snapshots of host groups, templates, user
+              groups and global macros under cache_dir, name lookups are
+              then answered from the snapshots.
+            - Writes made by these modules drop the snapshots they affect,
+              changes made elsewhere show up once the snapshot expires.
+            - C(0) disables the snapshots.
+        required: false
+        default: 0
+    retries:
+        description:
+            - Number of times a request is retried after a transient
+              failure, such as a timeout or an HTTP 502, 503 or 504.
+            - Reads are always retried, writes only when the server cannot
+              have processed them, for example when the connection was
+              refused or the frontend answered 503.
+        required: false
+        default: 3
+    retry_delay:
+        description:
+            - Base delay in seconds of the exponential backoff between
+              retries, each delay is randomized between zero and its
+              upper bound.
+        required: false
+        default: 0.5
+    retry_max_delay:
+        description:
+            - Upper bound in seconds of a single retry delay.
+        required: false
+        default: 10
+    circuit_threshold:
+        description:
+            - Consecutive calls failing with a transient error after their
+              retries, counted across all forks through cache_dir, after
+              which calls to server_url fail immediately for circuit_reset
+              seconds.
+            - C(0) disables the circuit breaker.
+        required: false
+        default: 5
+    circuit_reset:
+        description:
+            - Seconds to wait before trying a server again once the circuit
+              breaker opened.
+        required: false
+        default: 30
+    profile:
+        description:
+            - Add a C(zbx_timings) key to the result with the duration in
+              seconds of the login phase and of the whole module, and the
+              method, duration, request and response bytes of every API
+              call.
+            - The C(wait) of each call, and their total, is the time spent
+              waiting for rate_limit and max_concurrency.
+            - Calls that failed or timed out are listed with C(error) set.
+        required: false
+        default: false
+    rate_limit:
+        description:
+            - Maximum API requests per second sent to server_url, shared by
+              all forks on the controller through cache_dir.
+            - C(0) disables the rate limit.
+        required: false
+        default: 0
+    rate_burst:
+        description:
+            - Number of requests that may be sent at once before
+              rate_limit applies.
+        required: false
+        default: 10
+    max_concurrency:
+        description:
+            - Maximum API requests in flight to server_url at the same
+              time, across all forks on the controller.
+            - C(0) disables the cap.
+        required: false
+        default: 0
 '''
 
 EXAMPLES = '''
@@ -100,60 +209,60 @@ EXAMPLES = '''
     state: present
 '''
 
+# Module parameters and the usergroup fields they set
+GROUP_FIELDS = (
+    ('debug_mode', 'debug_mode'),
+    ('gui_access', 'gui_access'),
+    ('status', 'users_status'),
+)
+
+def rights_set(rights):
+    """Return rights as a set of (host group id, permission) pairs"""
+    return set([(str(right['id']), str(right['permission'])) for right in rights])
+
 class Group(AnsibleZabbix):
     """Return a Group object"""
     def __init__(self, module):
         super(Group, self).__init__(module)
 
 
-    def get_host_group_id(self, host_group_name):
-        """get host group ids by name"""
-        try:
-            group_list = self._zapi.hostgroup.get({
-                'output': 'extend',
-                'filter': {
-                    'name': host_group_name
-                }
-            })
-            if len(group_list) > 0:
-                return group_list[0]['groupid']
-            return None
-        except Exception as e:
-            self._module.fail_json(
-                msg="Failed to lookup host group %s: %s" % (host_group_name, e)
-            )
-
-    def get_group(self):
-        """get group"""
+    def lookup(self, host_group_names):
+        """get group and the ids of host_group_names in a single request"""
         group_name = self._module.params['name']
+        batch = self.batch()
+        self._resolver.queue(batch, 'hostgroup', host_group_names)
+        group_call = batch.usergroup.get({
+            'output': zbx_output('usergroup'),
+            'selectRights': zbx_output('right'),
+            'filter': {
+                'name': group_name
+            }
+        })
         try:
-            group_list = self._zapi.usergroup.get({
-                'output': 'extend',
-                'filter': {
-                    'name': group_name
-                }
-            })
-            if len(group_list) > 0:
-                return group_list[0]
-            return None
+            batch.send()
         except Exception as e:
             self._module.fail_json(
                 msg="Failed to get group %s: %s" % (group_name, e)
             )
+        host_group_ids = self.resolve_ids('hostgroup', host_group_names)
+        if len(group_call.result) > 0:
+            return host_group_ids, group_call.result[0]
+        return host_group_ids, None
 
     def create_group(self):
         """create group"""
         params = self._module.params
+        group_def = dict(
+            name=params['name'],
+            rights=params.get('rights') or []
+        )
+        for param, field in GROUP_FIELDS:
+            if params.get(param) is not None:
+                group_def[field] = params[param]
         try:
             if self._module.check_mode:
                 self._module.exit_json(changed=True)
-            self._zapi.usergroup.create({
-                'name': params['name'],
-                'debug_mode': params.get('debug_mode', 0),
-                'gui_access': params.get('gui_access', 0),
-                'user_status': params.get('status', 0),
-                'rights': params.get('rights', [])
-            })
+            self._zapi.usergroup.create(group_def)
             self._module.exit_json(
                 changed=True,
                 result="Successfully added group %s " % params['name']
@@ -164,28 +273,26 @@ class Group(AnsibleZabbix):
             )
 
     def update_group(self, group_obj):
-        """update group"""
+        """update the fields of the group that differ"""
         params = self._module.params
-        group_def = dict(
-            usrgrpid=group_obj['usrgrpid'],
-            name=params['name'] or group_obj['name'],
-            rights=params.get('rights') or group_obj.get('rights', [])
-        )
-        if params.get('debug_mode') is None:
-            group_def['debug_mode'] = group_obj.get('debug_mode', 0)
-        else:
-            group_def['debug_mode'] = params['debug_mode']
-
-        if params.get('gui_access') is None:
-            group_def['gui_access'] = group_obj.get('gui_access', 0)
-        else:
-            group_def['gui_access'] = params['gui_access']
-
-        if params.get('status') is None:
-            group_def['user_status'] = group_obj.get('user_status', 0)
-        else:
-            group_def['user_status'] = params['status']
+        group_def = {}
+        for param, field in GROUP_FIELDS:
+            if (
+                    params.get(param) is not None and
+                    str(params[param]) != str(group_obj.get(field))
+                ):
+                group_def[field] = params[param]
+        if params.get('rights') and (
+                rights_set(params['rights']) != rights_set(group_obj.get('rights', []))
+            ):
+            group_def['rights'] = params['rights']
 
+        if not group_def:
+            self._module.exit_json(
+                changed=False,
+                result="User group %s already up to date" % params['name']
+            )
+        group_def['usrgrpid'] = group_obj['usrgrpid']
         try:
             if self._module.check_mode:
                 self._module.exit_json(changed=True)
@@ -234,15 +341,10 @@ def main():
 
     group_class_obj = Group(module)
 
-    # Lookup and convert any hostgroup names to ids
     # Validate data structure
     for entry in module.params['rights']:
         if entry.get('host_group') is None:
             module.fail_json(msg="host_group value for rights is required")
-        else:
-            entry['id'] = group_class_obj.get_host_group_id(
-                entry.pop('host_group', None)
-            )
         if entry.get('permission') is None:
             module.fail_json(msg="Permission value for rights is required")
         elif entry['permission'] not in [0, 2, 3]:
@@ -250,7 +352,12 @@ def main():
                 msg="Value %s is not valid for permission right" % entry['permission']
             )
 
-    group_obj = group_class_obj.get_group()
+    # Lookup the group and convert any hostgroup names to ids
+    host_group_ids, group_obj = group_class_obj.lookup(
+        [entry['host_group'] for entry in module.params['rights']]
+    )
+    for entry in module.params['rights']:
+        entry['id'] = host_group_ids[entry.pop('host_group')]
 
     if module.params['state'] == 'absent':
         if not group_obj:
@@ -3,8 +3,10 @@
 
 """Ansible module to import value maps into Zabbix"""
 
+import xml.etree.ElementTree as ElementTree
+
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils.zabbix import AnsibleZabbix, zbx_argument_spec
+from ansible.module_utils.zabbix import AnsibleZabbix, zbx_argument_spec, zbx_output
 
 
 DOCUMENTATION = '''
@@ -13,15 +15,19 @@ module: zabbix_valuemap
 short_description: Import or remove zabbix value maps
 description:
     - Imports or Deletes Zabbix value maps using the Zabbix API
+    - Only the value maps whose mappings differ from the file are created
+      or updated, using the valuemap API of Zabbix 3.0 and later
 options:
     name:
         required: false
         description:
             - Name of the valuemap to delete, not required on import
     valuemap_file:
-        required: true
+        required: false
         description:
             - the xml file containing the value map definition
+            - Required on import, on removal all value maps of the file are
+              deleted when name is not set
     state:
         required: false
         default: "present"
@@ -31,16 +37,19 @@ options:
     server_url:
         description:
             - Url of Zabbix server, with protocol (http or https).
-        required: true
+            - Not needed with the zabbix httpapi connection plugin.
+        required: false
         aliases: [ "url" ]
     login_user:
         description:
             - Zabbix api user name.
-        required: true
+            - Not needed with the zabbix httpapi connection plugin.
+        required: false
     login_password:
         description:
             - Zabbix api user password.
-        required: true
+            - Not needed with the zabbix httpapi connection plugin.
+        required: false
     http_login_user:
         description:
             - Basic Auth login
@@ -55,6 +64,113 @@ options:
         description:
             - The timeout of API request (seconds).
         default: 10
+    session_cache:
+        description:
+            - Reuse a previously authenticated API session for the same
+              server_url and credentials instead of logging in on every task.
+            - Sessions are stored under cache_dir on the host running the
+              module and checked with user.checkAuthentication before use.
+        required: false
+        default: true
+    cache_dir:
+        description:
+            - Directory holding the session cache.
+        required: false
+        default: "~/.ansible/zabbix"
+    logout:
+        description:
+            - Log out of the API session when the task finishes and remove it
+              from the session cache, typically set on the last Zabbix task of
+              a play.
+            - Forks still running with the session log in again once when the
+              server reports it as terminated.
+        required: false
+        default: false
+    debug:
+        description:
+            - Add a C(zbx_debug) key to the result with API client
+              diagnostics, such as HTTP connection reuse counters.
+            - Also repeats every get with output extend to report the
+              response bytes saved by requesting only the needed fields.
+        required: false
+        default: false
+    cache_ttl:
+        description:
+            - Seconds to keep snapshots of host groups, templates, user
+              groups and global macros under cache_dir, name lookups are
+              then answered from the snapshots.
+            - Writes made by these modules drop the snapshots they affect,
+              changes made elsewhere show up once the snapshot expires.
+            - C(0) disables the snapshots.
+        required: false
+        default: 0
+    retries:
+        description:
+            - Number of times a request is retried after a transient
+              failure, such as a timeout or an HTTP 502, 503 or 504.
+            - Reads are always retried, writes only when the server cannot
+              have processed them, for example when the connection was
+              refused or the frontend answered 503.
+        required: false
+        default: 3
+    retry_delay:
+        description:
+            - Base delay in seconds of the exponential backoff between
+              retries, each delay is randomized between zero and its
+              upper bound.
+        required: false
+        default: 0.5
+    retry_max_delay:
+        description:
+            - Upper bound in seconds of a single retry delay.
+        required: false
+        default: 10
+    circuit_threshold:
+        description:
+            - Consecutive calls failing with a transient error after their
+              retries, counted across all forks through cache_dir, after
+              which calls to server_url fail immediately for circuit_reset
+              seconds.
+            - C(0) disables the circuit breaker.
+        required: false
+        default: 5
+    circuit_reset:
+        description:
+            - Seconds to wait before trying a server again once the circuit
+              breaker opened.
+        required: false
+        default: 30
+    profile:
+        description:
+            - Add a C(zbx_timings) key to the result with the duration in
+              seconds of the login phase and of the whole module, and the
+              method, duration, request and response bytes of every API
+              call.
+            - The C(wait) of each call, and their total, is the time spent
+              waiting for rate_limit and max_concurrency.
+            - Calls that failed or timed out are listed with C(error) set.
+        required: false
+        default: false
+    rate_limit:
+        description:
+            - Maximum API requests per second sent to server_url, shared by
+              all forks on the controller through cache_dir.
+            - C(0) disables the rate limit.
+        required: false
+        default: 0
+    rate_burst:
+        description:
+            - Number of requests that may be sent at once before
+              rate_limit applies.
+        required: false
+        default: 10
+    max_concurrency:
+        description:
+            - Maximum API requests in flight to server_url at the same
+              time, across all forks on the controller.
+            - C(0) disables the cap.
+        required: false
+        default: 0
 '''
 
 EXAMPLES = '''
@@ -68,6 +184,26 @@ EXAMPLES = '''
      state=present
 '''
 
+def parse_valuemap_file(valuemap_file):
+    """Return a dict of the value maps in an export file and their mappings"""
+    valuemaps = {}
+    root = ElementTree.parse(valuemap_file).getroot()
+    for value_map in root.findall('value_maps/value_map'):
+        valuemaps[value_map.findtext('name')] = [
+            {
+                'value': mapping.findtext('value') or '',
+                'newvalue': mapping.findtext('newvalue') or '',
+            }
+            for mapping in value_map.findall('mappings/mapping')
+        ]
+    return valuemaps
+
+def same_mappings(mappings, other):
+    """Compare two lists of mappings regardless of their order"""
+    def key(mapping):
+        return (mapping['value'], mapping['newvalue'])
+    return sorted(map(key, mappings)) == sorted(map(key, other))
+
 class ValueMap(AnsibleZabbix):
     """Return a valuemap class"""
 
@@ -78,61 +214,81 @@ class ValueMap(AnsibleZabbix):
         self.name = module.params['name']
 
 
-    def exists(self):
-        """Check if valuemap exists, return boolean"""
-        valuemap_list = self._zapi.valuemap.get({
-            'output': 'extend',
-            'filter': {
-                'host': self.name
-            }
-        })
-        if len(valuemap_list) < 1:
-            return False
-        else:
-            return True
-
-    def delete(self):
-        """Delete valuemap, return boolean"""
+    def read_file(self):
+        """Return the value maps defined in valuemap_file"""
         try:
-            valuemap_id = self._zapi.valuemap.get({
-                'output': 'extend',
-                'filter': {
-                    'host': self.name
-                }
-            })[0]['valuemapid']
-            self._zapi.valuemap.delete([valuemap_id])
-            return True
+            return parse_valuemap_file(self.valuemap_file)
         except Exception as eret:
             self._module.fail_json(
-                name=self.name,
-                msg="Failed to delete valuemap id: %u ; error was: %s" % (valuemap_id, eret)
+                msg="failed to read valuemap file %s: %s" % (self.valuemap_file, eret)
             )
 
-    def create(self):
-        """Create/Update valuemap, return boolean success value"""
+    def get_valuemaps(self, names):
+        """Return the existing value maps with their mappings, keyed by name"""
         try:
-            with open(self.valuemap_file, "r") as myfile:
-                config = myfile.read()
-        except:
+            valuemap_list = self._zapi.valuemap.get({
+                'output': zbx_output('valuemap'),
+                'selectMappings': zbx_output('mapping'),
+                'filter': {
+                    'name': names
+                }
+            })
+        except Exception as eret:
             self._module.fail_json(
-                msg="failed to read valuemap file: %s" % self.valuemap_file
+                msg="Failed to get valuemaps %s: %s" % (', '.join(names), eret)
             )
+        return dict([(valuemap['name'], valuemap) for valuemap in valuemap_list])
 
-        importrules = {
-            'valueMaps': {
-                'createMissing' : True,
-                'updateExisting': True,
-            }
-        }
-        parameters = {'format': 'xml', 'source': config, 'rules': importrules}
+    def apply(self, creates, updates, deletes, changes):
+        """Send the valuemap changes as one batch request"""
+        if not changes or self._module.check_mode:
+            return
+        batch = self.batch()
+        if creates:
+            batch.valuemap.create(creates)
+        if updates:
+            batch.valuemap.update(updates)
+        if deletes:
+            batch.valuemap.delete(deletes)
         try:
-            self._zapi.configuration.import_(parameters)
-            return True
+            batch.send()
         except Exception as eret:
             self._module.fail_json(
-                msg="failed to import valuemap: %s" % eret
+                msg="failed to update valuemaps: %s" % eret, valuemaps=changes
             )
 
+    def delete(self):
+        """Delete valuemap name or all value maps of valuemap_file, return changes"""
+        if self.name is not None:
+            names = [self.name]
+        else:
+            names = sorted(self.read_file())
+        existing = self.get_valuemaps(names)
+        changes = dict([(name, 'deleted') for name in existing])
+        self.apply([], [], [valuemap['valuemapid'] for valuemap in existing.values()], changes)
+        return changes
+
+    def create(self):
+        """Create/Update the value maps of valuemap_file that differ, return changes"""
+        desired = self.read_file()
+        existing = self.get_valuemaps(sorted(desired))
+        creates = []
+        updates = []
+        changes = {}
+        for name, mappings in sorted(desired.items()):
+            valuemap = existing.get(name)
+            if valuemap is None:
+                creates.append({'name': name, 'mappings': mappings})
+                changes[name] = 'created'
+            elif not same_mappings(valuemap.get('mappings', []), mappings):
+                updates.append({
+                    'valuemapid': valuemap['valuemapid'],
+                    'mappings': mappings
+                })
+                changes[name] = 'updated'
+        self.apply(creates, updates, [], changes)
+        return changes
+
 
 def main():
     """Do the needful"""
@@ -144,23 +300,30 @@ def main():
     ))
     module = AnsibleModule(
         argument_spec=argument_spec,
-        # Don't support check mode for now
-        supports_check_mode=False
+        supports_check_mode=True
     )
 
+    if module.params['state'] == 'present' and module.params['valuemap_file'] is None:
+        module.fail_json(msg="valuemap_file is a required parameter on import")
+    if module.params['state'] == 'absent' and (
+            module.params['valuemap_file'] is None and module.params['name'] is None
+        ):
+        module.fail_json(msg="Either name or valuemap_file must be set on remove")
+
     valuemap = ValueMap(module)
 
     if valuemap.state == 'absent':
-        if valuemap.exists():
-            valuemap.delete()
-            module.exit_json(
-                changed=True,
-                result="Successfully deleted valuemap %s" % valuemap.name
-            )
+        changes = valuemap.delete()
+        module.exit_json(
+            changed=bool(changes),
+            valuemaps=changes,
+            result="Successfully deleted %d valuemaps" % len(changes)
+        )
     elif valuemap.state == 'present':
-        valuemap.create()
+        changes = valuemap.create()
         module.exit_json(
-            changed=True,
+            changed=bool(changes),
+            valuemaps=changes,
             result="Successfully imported valuemap file %s" % valuemap.valuemap_file
         )
 
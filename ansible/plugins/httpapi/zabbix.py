@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Ansible httpapi plugin keeping one authenticated Zabbix API session per play"""
+
+import json
+
+from ansible.module_utils._text import to_text
+from ansible.module_utils.connection import ConnectionError
+from ansible.plugins.httpapi import HttpApiBase
+
+
+DOCUMENTATION = '''
+---
+httpapi: zabbix
+short_description: Persistent connection to the Zabbix JSON-RPC API
+description:
+    - Logs in to the Zabbix API once per play with ansible_user and
+      ansible_httpapi_pass and sends the API calls of the zabbix modules over
+      the persistent connection, so modules skip the login and connection
+      setup. The session is logged out when the connection is closed.
+    - Use it with C(ansible_connection=httpapi) and
+      C(ansible_network_os=zabbix), the server_url, login_user and
+      login_password module options are then not needed.
+options:
+    zabbix_url_path:
+        description:
+            - Path of the Zabbix frontend on the web server.
+        default: zabbix
+        vars:
+            - name: ansible_zabbix_url_path
+'''
+
+BASE_HEADERS = {
+    'Content-Type': 'application/json-rpc',
+    'Accept': 'application/json',
+}
+
+# Error data returned when the session expired and needs a new login
+SESSION_ERRORS = ('Session terminated', 'Not authorised', 'Not authorized')
+
+class HttpApi(HttpApiBase):
+    """Zabbix httpapi plugin"""
+
+    def __init__(self, connection):
+        super(HttpApi, self).__init__(connection)
+        self._session = None
+        self._id = 0
+
+    def _path(self):
+        url_path = (self.get_option('zabbix_url_path') or '').strip('/')
+        if url_path:
+            return '/%s/api_jsonrpc.php' % url_path
+        return '/api_jsonrpc.php'
+
+    def endpoint(self):
+        """Return the API URL, which modules use to key their controller-local state"""
+        port = self.connection.get_option('port')
+        return '%s://%s%s%s' % (
+            'https' if self.connection.get_option('use_ssl') else 'http',
+            self.connection.get_option('host'),
+            ':%s' % port if port else '',
+            self._path()
+        )
+
+    def _post(self, payload):
+        _, response_data = self.connection.send(
+            self._path(), json.dumps(payload), method='POST', headers=BASE_HEADERS
+        )
+        return json.loads(to_text(response_data.getvalue(), errors='surrogate_then_replace'))
+
+    def _call(self, method, params, auth=True):
+        self._id += 1
+        request = {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': self._id}
+        if auth:
+            request['auth'] = self._session
+        response = self._post(request)
+        if 'error' in response:
+            error = response['error']
+            raise ConnectionError("Error %s: %s, %s" % (
+                error['code'], error['message'], error.get('data')
+            ))
+        return response.get('result')
+
+    def login(self, username, password):
+        """Open the API session of the play"""
+        self._session = self._call(
+            'user.login', {'user': username, 'password': password}, auth=False
+        )
+
+    def logout(self):
+        """Close the API session when the persistent connection ends"""
+        if self._session:
+            try:
+                self._call('user.logout', [])
+            finally:
+                self._session = None
+
+    def _expired(self, responses):
+        return any([
+            any([marker in str(response.get('error', {}).get('data', ''))
+                 for marker in SESSION_ERRORS])
+            for response in responses
+        ])
+
+    def send_request(self, data, **message_kwargs):
+        """Send a JSON-RPC request or batch from a module with the play's session
+
+        Requests carrying an auth member get the session id of the play, the
+        session is renewed once if the server reports it as expired.
+        """
+        payload = json.loads(data)
+        requests = payload if isinstance(payload, list) else [payload]
+        for attempt in range(2):
+            for request in requests:
+                if 'auth' in request:
+                    request['auth'] = self._session
+            response = self._post(payload)
+            responses = response if isinstance(response, list) else [response]
+            if attempt or not self._expired(responses):
+                break
+            self.login(
+                self.connection.get_option('remote_user'),
+                self.connection.get_option('password')
+            )
+        return json.dumps(response)
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding:utf8 -*-
+"""Check the API calls of every module against fixed budgets
+
+Each sequence runs one module through its create, no-op, update and delete
+paths against a fresh fake Zabbix API, recording the calls of every step.
+A step fails when the module reports the wrong changed status or makes more
+calls or HTTP requests than its budget allows. calls and requests are
+exact counts, max_calls and max_requests upper bounds.
+
+Steps share a session cache, so the first step of a sequence logs in and
+the others validate the cached session, one call either way.
+
+usage: python bench/budgets.py [--only MODULE] [--verbose]
+"""
+
+import argparse
+import gzip
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from fakezbx import FakeZabbixServer
+from run import run_module, template_xml, valuemap_xml
+
+GROUPS = ['Operators %d' % i for i in range(5)]
+USERS = ['user%02d' % i for i in range(20)]
+HOST_GROUPS = ['Hosts %d' % i for i in range(5)]
+
+class Step(object):
+    """One module run and the calls it may make"""
+
+    def __init__(self, phase, args, changed, calls=None, requests=None,
+                 max_calls=None, max_requests=None):
+        self.phase = phase
+        self.args = args
+        self.changed = changed
+        self.budget = dict(
+            calls=calls, requests=requests,
+            max_calls=max_calls, max_requests=max_requests
+        )
+
+    def check(self, result, recorded):
+        """Return the reasons this step failed, if any"""
+        errors = []
+        if result.get('failed'):
+            return ['failed: %s' % result.get('msg')]
+        if result.get('changed') != self.changed:
+            errors.append('changed=%s, expected %s' % (result.get('changed'), self.changed))
+        measured = dict(calls=len(recorded.calls), requests=recorded.requests)
+        for metric in ('calls', 'requests'):
+            exact = self.budget[metric]
+            maximum = self.budget['max_' + metric]
+            if exact is not None and measured[metric] != exact:
+                errors.append('%d %s, expected %d' % (measured[metric], metric, exact))
+            if maximum is not None and measured[metric] > maximum:
+                errors.append('%d %s, at most %d allowed' % (measured[metric], metric, maximum))
+        return errors
+
+class Sequence(object):
+    """Steps of one module run in order against the same server"""
+
+    def __init__(self, name, module, steps, seed=None, files=None):
+        self.name = name
+        self.module = module
+        self.steps = steps
+        self.seed = seed or {}
+        self.files = files or {}
+
+def user_sequence():
+    def user(**fields):
+        return dict(dict(user_alias='jdoe', user_password='secret', user_groups=GROUPS), **fields)
+    return Sequence('user', 'zabbix_user', seed={'usergroup': ['Guests'] + GROUPS}, steps=[
+        Step('create', user(), True, calls=4, requests=3),
+        # zabbix_user with 5 groups, no-op run: session check and one batched lookup
+        Step('noop', user(), False, calls=3, requests=2),
+        Step('update', user(user_name='John'), True, calls=4, requests=3),
+        Step('delete', user(state='absent'), True, calls=4, requests=3),
+        Step('noop delete', user(state='absent'), False, calls=3, requests=2),
+    ])
+
+def users_sequence():
+    def users(**fields):
+        return dict(users=[
+            dict(dict(alias=alias, password='secret', groups=GROUPS[:2]), **fields)
+            for alias in USERS
+        ])
+    return Sequence('users', 'zabbix_user', seed={'usergroup': ['Guests'] + GROUPS}, steps=[
+        Step('create', users(), True, calls=4, requests=3),
+        Step('noop', users(), False, calls=3, requests=2),
+        Step('update', users(name='Updated'), True, calls=4, requests=3),
+        Step('delete', users(state='absent'), True, calls=4, requests=3),
+    ])
+
+def usergroup_sequence():
+    def group(**fields):
+        return dict(dict(name='Operators', rights=[
+            dict(host_group=name, permission=2) for name in HOST_GROUPS
+        ]), **fields)
+    return Sequence('usergroup', 'zabbix_usergroup', seed={'hostgroup': HOST_GROUPS}, steps=[
+        Step('create', group(), True, calls=4, requests=3),
+        Step('noop', group(), False, calls=3, requests=2),
+        Step('update', group(gui_access=2), True, calls=4, requests=3),
+        Step('delete', group(state='absent'), True, calls=4, requests=3),
+    ])
+
+def globalmacro_sequence():
+    return Sequence('globalmacro', 'zabbix_globalmacro', steps=[
+        Step('create', dict(macro_name='SNMP_COMMUNITY', macro_value='public'), True,
+             calls=3, requests=3),
+        Step('noop', dict(macro_name='SNMP_COMMUNITY', macro_value='public'), False,
+             calls=2, requests=2),
+        Step('update', dict(macro_name='SNMP_COMMUNITY', macro_value='private'), True,
+             calls=3, requests=3),
+        Step('delete', dict(macro_name='SNMP_COMMUNITY', state='absent'), True,
+             calls=3, requests=3),
+    ])
+
+def globalmacros_sequence():
+    def macros(value):
+        return dict(macros=dict([('MACRO_%d' % i, value) for i in range(20)]))
+    return Sequence('globalmacros', 'zabbix_globalmacro', steps=[
+        Step('create', macros('one'), True, calls=3, requests=3),
+        Step('noop', macros('one'), False, calls=2, requests=2),
+        Step('update', macros('two'), True, calls=3, requests=3),
+        Step('delete', dict(macros(''), state='absent'), True, calls=3, requests=3),
+    ])
+
+def template_sequence():
+    return Sequence(
+        'template', 'zabbix_template',
+        files={
+            'v1.xml': template_xml('Template App'),
+            'v2.xml': template_xml('Template App').replace('Agent ping', 'Agent availability'),
+        },
+        steps=[
+            Step('create', dict(template_file='v1.xml'), True, calls=5, requests=5),
+            Step('noop', dict(template_file='v1.xml'), False, calls=2, requests=2),
+            Step('update', dict(template_file='v2.xml'), True, calls=5, requests=5),
+            # Other sections change the digest, the file is imported again
+            Step('sections', dict(template_file='v2.xml', sections=['items']), True,
+                 calls=5, requests=5),
+            Step('noop sections', dict(template_file='v2.xml', sections=['items']), False,
+                 calls=2, requests=2),
+            Step('rename', dict(template_name='Template App', rename='Template Application'),
+                 True, calls=3, requests=3),
+            Step('delete', dict(template_name='Template Application', state='absent'), True,
+                 calls=3, requests=3),
+            Step('noop delete', dict(template_name='Template Application', state='absent'),
+                 False, calls=2, requests=2),
+        ]
+    )
+
+def templates_sequence():
+    files = dict([
+        ('templates/template_%02d.xml' % i, template_xml('Template %02d' % i))
+        for i in range(10)
+    ])
+    return Sequence('templates', 'zabbix_template', files=files, steps=[
+        # One digest check, an import per file, then one digest lookup and
+        # one batch of digest macros for the layer
+        Step('create', dict(template_files=['templates/*.xml']), True,
+             calls=14, requests=14),
+        Step('noop', dict(template_files=['templates/*.xml']), False, calls=2, requests=2),
+    ])
+
+def bulk_template_sequence():
+    files = dict([
+        ('templates/template_%02d.xml' % i, template_xml('Template %02d' % i))
+        for i in range(10)
+    ])
+    # Template 10 links to Template 00, it has to be deleted first
+    files['templates/template_10.xml'] = template_xml('Template 10').replace(
+        '<items>', '<templates><template><name>Template 00</name></template></templates><items>'
+    )
+    names = ['Template %02d' % i for i in range(11)]
+    renames = dict([(name, name.replace('Template', 'Legacy')) for name in names])
+    legacy = sorted(renames.values())
+    return Sequence('templates bulk', 'zabbix_template', files=files, steps=[
+        # Two layers, digests are recorded after each
+        Step('import', dict(template_files=['templates/*.xml']), True,
+             calls=17, requests=17),
+        Step('rename', dict(renames=renames), True, calls=3, requests=3),
+        Step('noop rename', dict(renames=renames), False, calls=2, requests=2),
+        Step('delete', dict(template_names=legacy, state='absent'), True,
+             calls=3, requests=3),
+        Step('noop delete', dict(template_names=legacy, state='absent'), False,
+             calls=2, requests=2),
+    ])
+
+def compressed_template_sequence():
+    export = json.dumps({'zabbix_export': {
+        'version': '3.4',
+        'date': '2018-01-01T00:00:00Z',
+        'groups': [{'name': 'Templates'}],
+        'templates': [{
+            'template': 'Template JSON', 'name': 'Template JSON',
+            'groups': [{'name': 'Templates'}],
+            'items': [{'name': 'Agent ping', 'key': 'agent.ping'}],
+        }],
+    }})
+    compressed = io.BytesIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb') as gzip_file:
+        gzip_file.write(export.encode('utf-8'))
+    return Sequence(
+        'template json.gz', 'zabbix_template',
+        files={'template.json.gz': compressed.getvalue()},
+        steps=[
+            Step('create', dict(template_file='template.json.gz'), True, calls=5, requests=5),
+            Step('noop', dict(template_file='template.json.gz'), False, calls=2, requests=2),
+        ]
+    )
+
+def valuemap_sequence():
+    return Sequence(
+        'valuemap', 'zabbix_valuemap',
+        files={
+            'v1.xml': valuemap_xml(['Service state', 'Host status']),
+            'v2.xml': valuemap_xml(['Service state', 'Host status']).replace('Down', 'Stopped', 1),
+        },
+        steps=[
+            Step('create', dict(valuemap_file='v1.xml'), True, calls=3, requests=3),
+            Step('noop', dict(valuemap_file='v1.xml'), False, calls=2, requests=2),
+            Step('update', dict(valuemap_file='v2.xml'), True, calls=3, requests=3),
+            Step('delete', dict(valuemap_file='v2.xml', state='absent'), True,
+                 calls=3, requests=3),
+            Step('noop delete', dict(valuemap_file='v2.xml', state='absent'), False,
+                 calls=2, requests=2),
+        ]
+    )
+
+SEQUENCES = [
+    user_sequence,
+    users_sequence,
+    usergroup_sequence,
+    globalmacro_sequence,
+    globalmacros_sequence,
+    template_sequence,
+    templates_sequence,
+    bulk_template_sequence,
+    compressed_template_sequence,
+    valuemap_sequence,
+]
+
+def in_workdir(args, workdir):
+    """Make the file arguments of a step relative to workdir"""
+    args = dict(args)
+    for key in ('template_file', 'valuemap_file'):
+        if key in args:
+            args[key] = os.path.join(workdir, args[key])
+    if 'template_files' in args:
+        args['template_files'] = [os.path.join(workdir, p) for p in args['template_files']]
+    return args
+
+def run_sequence(sequence, verbose=False):
+    """Run every step of sequence, return the number of failed steps"""
+    server = FakeZabbixServer().start()
+    workdir = tempfile.mkdtemp(prefix='zbxbudget')
+    failures = 0
+    try:
+        for object_type, names in sequence.seed.items():
+            for name in names:
+                server.zabbix.add(object_type, name=name)
+        for path, content in sequence.files.items():
+            path = os.path.join(workdir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb' if isinstance(content, bytes) else 'w') as f:
+                f.write(content)
+        for step in sequence.steps:
+            with server.zabbix.recording() as recorded:
+                result, _ = run_module(
+                    server, sequence.module, in_workdir(step.args, workdir), workdir
+                )
+            errors = step.check(result, recorded)
+            failures += bool(errors)
+            print('%-26s %-12s %3d calls %3d requests %s' % (
+                sequence.name, step.phase, len(recorded.calls), recorded.requests,
+                'FAILED: ' + '; '.join(errors) if errors else 'ok'
+            ))
+            if verbose or errors:
+                print('    %s' % ', '.join(recorded.calls))
+    finally:
+        server.stop()
+        shutil.rmtree(workdir)
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--only', action='append',
+                        help='only run the sequences of this module, repeatable')
+    parser.add_argument('--verbose', action='store_true',
+                        help='list the calls of every step')
+    options = parser.parse_args()
+
+    failures = 0
+    for make_sequence in SEQUENCES:
+        sequence = make_sequence()
+        if options.only and sequence.module not in options.only:
+            continue
+        failures += run_sequence(sequence, options.verbose)
+    if failures:
+        print('%d steps over budget' % failures)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
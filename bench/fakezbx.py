@@ -0,0 +1,348 @@
+# -*- coding:utf8 -*-
+"""In-memory stand-in for the Zabbix JSON-RPC API
+
+Implements the subset of the API used by the modules, enough to run them
+against a local server and count the calls and bytes they cost.
+"""
+
+import contextlib
+import itertools
+import json
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+ID_FIELDS = {
+    'hostgroup': 'groupid',
+    'hostmacro': 'hostmacroid',
+    'template': 'templateid',
+    'user': 'userid',
+    'usergroup': 'usrgrpid',
+    'usermacro': 'globalmacroid',
+    'valuemap': 'valuemapid',
+}
+
+# Fields looked up often enough to be indexed, keeps large scales linear
+INDEX_FIELDS = {
+    'hostgroup': 'name',
+    'hostmacro': 'hostid',
+    'template': 'host',
+    'user': 'alias',
+    'usergroup': 'name',
+    'usermacro': 'macro',
+    'valuemap': 'name',
+}
+
+class FakeZabbixError(Exception):
+    """Returned to the client as a JSON-RPC error"""
+
+class FakeZabbixRecording(object):
+    """Calls and HTTP requests received while FakeZabbix.recording() was active"""
+
+    def __init__(self):
+        self.calls = []
+        self.requests = 0
+        self.bytes = 0
+
+class FakeZabbix(object):
+    """Object store answering JSON-RPC requests"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = dict([(object_type, {}) for object_type in ID_FIELDS])
+        self._indexes = dict([(object_type, {}) for object_type in ID_FIELDS])
+        self._ids = itertools.count(1)
+        self.reset_counters()
+
+    def reset_counters(self):
+        """Forget the calls and bytes counted so far"""
+        self.calls = []
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @contextlib.contextmanager
+    def recording(self):
+        """Record the API methods called within the with block"""
+        recording = FakeZabbixRecording()
+        calls, requests = len(self.calls), self.requests
+        bytes_transferred = self.bytes_in + self.bytes_out
+        try:
+            yield recording
+        finally:
+            with self.lock:
+                recording.calls = self.calls[calls:]
+                recording.requests = self.requests - requests
+                recording.bytes = self.bytes_in + self.bytes_out - bytes_transferred
+
+    def add(self, object_type, **fields):
+        """Store an object and return it with its new id"""
+        obj = {ID_FIELDS[object_type]: str(next(self._ids))}
+        self.objects[object_type][obj[ID_FIELDS[object_type]]] = obj
+        for key, value in fields.items():
+            self._set(object_type, obj, key, value)
+        return obj
+
+    def remove(self, object_type, object_id):
+        obj = self.objects[object_type].pop(object_id)
+        self._set(object_type, obj, INDEX_FIELDS[object_type], None)
+
+    def _set(self, object_type, obj, key, value):
+        """Set a field of a stored object, keeping the index up to date"""
+        if key == INDEX_FIELDS[object_type]:
+            index = self._indexes[object_type]
+            object_id = obj[ID_FIELDS[object_type]]
+            index.get(obj.get(key), set()).discard(object_id)
+            if value is not None:
+                index.setdefault(value, set()).add(object_id)
+        obj[key] = value
+
+    def lookup(self, object_type, field, values):
+        """Return the stored objects whose field is one of values"""
+        if field == INDEX_FIELDS[object_type]:
+            return [
+                self.objects[object_type][object_id]
+                for value in values
+                for object_id in sorted(self._indexes[object_type].get(value, ()))
+            ]
+        return [obj for obj in self.objects[object_type].values() if obj.get(field) in values]
+
+    def handle(self, request):
+        """Return the JSON-RPC response to a single request"""
+        response = {'jsonrpc': '2.0', 'id': request.get('id')}
+        try:
+            response['result'] = self.call(request['method'], request.get('params'))
+        except (FakeZabbixError, KeyError, TypeError, ValueError) as e:
+            response['error'] = {
+                'code': -32602, 'message': 'Invalid params.', 'data': str(e)
+            }
+        return response
+
+    def call(self, method, params):
+        self.calls.append(method)
+        if method == 'user.login':
+            return '0424bd59b807674191e7d77572075f33'
+        if method == 'user.checkAuthentication':
+            return {'sessionid': params['sessionid']}
+        if method == 'user.logout':
+            return True
+        if method == 'apiinfo.version':
+            return '3.4.0'
+        if method == 'configuration.import':
+            return self._import(params)
+        object_type, action = method.split('.', 1)
+        if object_type == 'usermacro' and action in ('create', 'update', 'delete', 'get'):
+            # Host and template macros, global macros use the *global actions
+            if action != 'get' or 'globalmacro' not in params:
+                object_type = 'hostmacro'
+        action = action.replace('global', '')
+        if object_type not in ID_FIELDS:
+            raise FakeZabbixError('unsupported method %s' % method)
+        return getattr(self, '_' + action)(object_type, params)
+
+    def _get(self, object_type, params):
+        id_field = ID_FIELDS[object_type]
+        conditions = dict([
+            (field, self._values(values))
+            for field, values in (params.get('filter') or {}).items()
+        ])
+        if id_field + 's' in params:
+            conditions[id_field] = self._values(params[id_field + 's'])
+        if object_type == 'hostmacro' and 'hostids' in params:
+            conditions['hostid'] = self._values(params['hostids'])
+        related = self._related(params)
+        candidates = self.objects[object_type].values()
+        if INDEX_FIELDS[object_type] in conditions:
+            candidates = self.lookup(
+                object_type, INDEX_FIELDS[object_type],
+                sorted(conditions[INDEX_FIELDS[object_type]])
+            )
+        return [
+            self._output(obj, params, related)
+            for obj in candidates
+            if all([str(obj.get(field)) in values for field, values in conditions.items()])
+        ]
+
+    def _values(self, values):
+        if not isinstance(values, list):
+            values = [values]
+        return set([str(value) for value in values])
+
+    def _related(self, params):
+        """Return the functions listing the objects of each select* parameter"""
+        def lookup(object_type, key):
+            return lambda obj: [
+                self.objects[object_type][object_id] for object_id in obj.get(key, [])
+                if object_id in self.objects[object_type]
+            ]
+        return {
+            'selectUsrgrps': ('usrgrps', lookup('usergroup', '_usrgrps')),
+            'selectRights': ('rights', lambda obj: obj.get('_rights', [])),
+            'selectMappings': ('mappings', lambda obj: obj.get('_mappings', [])),
+            'selectMacros': ('macros', lambda obj: self.lookup(
+                'hostmacro', 'hostid', [obj.get('templateid')]
+            )),
+            'selectParentTemplates': ('parentTemplates', lookup('template', '_parents')),
+        }
+
+    def _project(self, obj, output):
+        if output in (None, 'extend'):
+            return dict([(k, v) for k, v in obj.items() if not k.startswith('_')])
+        return dict([(k, obj[k]) for k in output if k in obj])
+
+    def _output(self, obj, params, related):
+        result = self._project(obj, params.get('output', 'extend'))
+        for select, (key, objects) in related.items():
+            if select in params:
+                result[key] = [self._project(item, params[select]) for item in objects(obj)]
+        return result
+
+    def _store_fields(self, object_type, obj, fields):
+        for key, value in fields.items():
+            if key == 'usrgrps':
+                obj['_usrgrps'] = [str(group['usrgrpid']) for group in value]
+            elif key == 'rights':
+                obj['_rights'] = [
+                    {'id': str(right['id']), 'permission': str(right['permission'])}
+                    for right in value
+                ]
+            elif key == 'mappings':
+                obj['_mappings'] = [
+                    {'value': str(m['value']), 'newvalue': str(m['newvalue'])}
+                    for m in value
+                ]
+            elif key not in ('passwd', ID_FIELDS[object_type]):
+                self._set(object_type, obj, key, str(value))
+
+    def _create(self, object_type, params):
+        created = []
+        for fields in params if isinstance(params, list) else [params]:
+            obj = self.add(object_type)
+            self._store_fields(object_type, obj, fields)
+            created.append(obj[ID_FIELDS[object_type]])
+        return {ID_FIELDS[object_type] + 's': created}
+
+    def _update(self, object_type, params):
+        id_field = ID_FIELDS[object_type]
+        updated = []
+        for fields in params if isinstance(params, list) else [params]:
+            obj = self.objects[object_type].get(str(fields[id_field]))
+            if obj is None:
+                raise FakeZabbixError('No permissions to referred object or it does not exist!')
+            self._store_fields(object_type, obj, fields)
+            updated.append(obj[id_field])
+        return {id_field + 's': updated}
+
+    def _delete(self, object_type, params):
+        for object_id in params:
+            if str(object_id) not in self.objects[object_type]:
+                raise FakeZabbixError('No permissions to referred object or it does not exist!')
+        for object_id in params:
+            self.remove(object_type, str(object_id))
+        return {ID_FIELDS[object_type] + 's': [str(i) for i in params]}
+
+    def _import(self, params):
+        """Create or update the templates of an XML or JSON export"""
+        if params['format'] == 'json':
+            export = json.loads(params['source'])['zabbix_export']
+            templates = [
+                (t['template'], [l['name'] for l in t.get('templates', [])])
+                for t in export.get('templates', [])
+            ]
+        elif params['format'] == 'xml':
+            root = ElementTree.fromstring(params['source'])
+            templates = [
+                (t.findtext('template'), [l.findtext('name') for l in t.findall('templates/template')])
+                for t in root.findall('templates/template')
+            ]
+        else:
+            raise FakeZabbixError('unsupported format %s' % params['format'])
+        for host, linked in templates:
+            parents = self.lookup('template', 'host', linked)
+            if len(parents) != len(set(linked)):
+                raise FakeZabbixError('Cannot find template "%s".' % ', '.join(linked))
+            existing = self.lookup('template', 'host', [host])
+            if existing:
+                template = existing[0]
+                # Importing a template replaces the macros it does not define
+                for macro in self.lookup('hostmacro', 'hostid', [template['templateid']]):
+                    self.remove('hostmacro', macro['hostmacroid'])
+            else:
+                template = self.add('template', host=host, name=host)
+            template['_parents'] = [parent['templateid'] for parent in parents]
+        return True
+
+class FakeZabbixHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, do not let Nagle delay the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        zabbix = self.server.zabbix
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        payload = json.loads(body.decode('utf-8'))
+        with zabbix.lock:
+            zabbix.requests += 1
+            zabbix.bytes_in += len(body)
+            if isinstance(payload, list):
+                response = [zabbix.handle(request) for request in payload]
+            else:
+                response = zabbix.handle(payload)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        data = json.dumps(response).encode('utf-8')
+        with zabbix.lock:
+            zabbix.bytes_out += len(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class FakeZabbixServer(ThreadingMixIn, HTTPServer):
+    """HTTP front end of a FakeZabbix store on 127.0.0.1
+
+    Every HTTP request, single or batch, is delayed by latency seconds.
+    """
+    daemon_threads = True
+
+    def __init__(self, zabbix=None, latency=0.0, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeZabbixHandler)
+        self.zabbix = zabbix or FakeZabbix()
+        self.latency = latency
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        """Serve requests from a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == '__main__':
+    import sys
+    server = FakeZabbixServer(
+        port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080,
+        latency=float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    )
+    server.zabbix.add('usergroup', name='Guests', debug_mode='0', gui_access='0', users_status='0')
+    sys.stdout.write('Serving a fake Zabbix API on %s\n' % server.url)
+    server.serve_forever()
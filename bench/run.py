@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding:utf8 -*-
+"""Benchmark the modules against a local fake Zabbix API
+
+Every module runs in its own process, as it would under ansible, with the
+installed ansible package and the modules and module_utils of this tree.
+Each scenario is run at every scale, first against an empty server and then
+a second time when nothing has to change. Wall time, API calls, HTTP
+requests and bytes transferred are compared with a stored baseline and the
+run fails when any of them regressed. Wall times depend on the machine and
+are only compared with --compare-wall.
+
+usage: python bench/run.py [--scales 1,100,10000] [--latency SECONDS]
+                           [--only MODULE] [--compare-wall] [--update]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fakezbx import FakeZabbixServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+# Allowed growth over the baseline, calls may never grow
+BYTES_TOLERANCE = 1.05
+WALL_TOLERANCE = 1.5
+WALL_SLACK = 0.1
+
+class Scenario(object):
+    """Arguments and server contents of one module at a given scale"""
+    module = None
+    phases = ('create', 'noop')
+
+    def setup(self, zabbix, scale, workdir):
+        """Seed the server and write the files the module needs"""
+        pass
+
+class UserScenario(Scenario):
+    module = 'zabbix_user'
+
+    def setup(self, zabbix, scale, workdir):
+        zabbix.add('usergroup', name='Guests')
+        zabbix.add('usergroup', name='Operators')
+
+    def args(self, phase, scale, workdir):
+        return dict(users=[
+            dict(
+                alias='user%05d' % i,
+                password='secret',
+                name='User',
+                surname='%05d' % i,
+                groups=['Operators'],
+            )
+            for i in range(scale)
+        ])
+
+class UserGroupScenario(Scenario):
+    module = 'zabbix_usergroup'
+
+    def setup(self, zabbix, scale, workdir):
+        for i in range(scale):
+            zabbix.add('hostgroup', name='Hosts %05d' % i)
+
+    def args(self, phase, scale, workdir):
+        return dict(name='Operators', rights=[
+            dict(host_group='Hosts %05d' % i, permission=2) for i in range(scale)
+        ])
+
+class GlobalMacroScenario(Scenario):
+    module = 'zabbix_globalmacro'
+
+    def args(self, phase, scale, workdir):
+        return dict(macros=dict([
+            ('MACRO_%05d' % i, 'value %d' % i) for i in range(scale)
+        ]))
+
+class TemplateScenario(Scenario):
+    module = 'zabbix_template'
+
+    def setup(self, zabbix, scale, workdir):
+        os.mkdir(os.path.join(workdir, 'templates'))
+        for i in range(scale):
+            path = os.path.join(workdir, 'templates', 'template_%05d.xml' % i)
+            with open(path, 'w') as template_file:
+                template_file.write(template_xml('Template %05d' % i))
+
+    def args(self, phase, scale, workdir):
+        return dict(template_files=[os.path.join(workdir, 'templates', '*.xml')])
+
+class ValueMapScenario(Scenario):
+    module = 'zabbix_valuemap'
+
+    def setup(self, zabbix, scale, workdir):
+        with open(os.path.join(workdir, 'valuemaps.xml'), 'w') as valuemap_file:
+            valuemap_file.write(valuemap_xml(['Value map %05d' % i for i in range(scale)]))
+
+    def args(self, phase, scale, workdir):
+        return dict(valuemap_file=os.path.join(workdir, 'valuemaps.xml'))
+
+SCENARIOS = [
+    UserScenario(),
+    UserGroupScenario(),
+    GlobalMacroScenario(),
+    TemplateScenario(),
+    ValueMapScenario(),
+]
+
+def template_xml(name):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<zabbix_export><version>3.4</version><date>2018-01-01T00:00:00Z</date>'
+        '<groups><group><name>Templates</name></group></groups>'
+        '<templates><template><template>%s</template><name>%s</name>'
+        '<groups><group><name>Templates</name></group></groups>'
+        '<items><item><name>Agent ping</name><key>agent.ping</key></item></items>'
+        '</template></templates></zabbix_export>\n'
+    ) % (name, name)
+
+def valuemap_xml(names):
+    value_maps = ''.join([
+        '<value_map><name>%s</name><mappings>'
+        '<mapping><value>0</value><newvalue>Down</newvalue></mapping>'
+        '<mapping><value>1</value><newvalue>Up</newvalue></mapping>'
+        '</mappings></value_map>' % name
+        for name in names
+    ])
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<zabbix_export><version>3.4</version><value_maps>%s</value_maps></zabbix_export>\n'
+    ) % value_maps
+
+def exec_module(module, args_file):
+    """Run a module of this tree as ansible would, report its wall time on stderr"""
+    import runpy
+    import ansible.module_utils
+    import ansible.modules
+    ansible.module_utils.__path__.insert(0, os.path.join(REPO_DIR, 'ansible', 'module_utils'))
+    ansible.modules.__path__.insert(0, os.path.join(REPO_DIR, 'ansible', 'modules'))
+    sys.argv = [module, args_file]
+    started = time.time()
+    try:
+        runpy.run_module('ansible.modules.zabbix.' + module, run_name='__main__')
+    finally:
+        sys.stderr.write('\n%s\n' % json.dumps({'wall': time.time() - started}))
+
+def run_module(server, module, args, workdir):
+    """Run module in a child process and return its result and wall time"""
+    args = dict(
+        args,
+        server_url=server.url,
+        login_user='Admin',
+        login_password='zabbix',
+        cache_dir=os.path.join(workdir, 'cache'),
+    )
+    args_file = os.path.join(workdir, 'args.json')
+    with open(args_file, 'w') as f:
+        json.dump({'ANSIBLE_MODULE_ARGS': args}, f)
+    child = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--exec', module, args_file],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    out, err = child.communicate()
+    try:
+        result = json.loads(out.decode('utf-8'))
+        wall = json.loads(err.decode('utf-8').strip().splitlines()[-1])['wall']
+    except (ValueError, IndexError, KeyError):
+        raise RuntimeError('%s did not return a result:\n%s%s' % (
+            module, out.decode('utf-8'), err.decode('utf-8')
+        ))
+    return result, wall
+
+def run_scenario(scenario, scale, latency):
+    """Return the measurements of every phase of scenario, keyed by phase"""
+    server = FakeZabbixServer(latency=latency).start()
+    workdir = tempfile.mkdtemp(prefix='zbxbench')
+    try:
+        scenario.setup(server.zabbix, scale, workdir)
+        measurements = {}
+        for phase in scenario.phases:
+            server.zabbix.reset_counters()
+            result, wall = run_module(
+                server, scenario.module, scenario.args(phase, scale, workdir), workdir
+            )
+            if result.get('failed'):
+                raise RuntimeError('%s %s failed: %s' % (
+                    scenario.module, phase, result.get('msg')
+                ))
+            if result.get('changed') != (phase != 'noop'):
+                raise RuntimeError('%s %s returned changed=%s' % (
+                    scenario.module, phase, result.get('changed')
+                ))
+            measurements[phase] = dict(
+                wall=round(wall, 4),
+                calls=len(server.zabbix.calls),
+                requests=server.zabbix.requests,
+                bytes=server.zabbix.bytes_in + server.zabbix.bytes_out,
+            )
+        return measurements
+    finally:
+        server.stop()
+        shutil.rmtree(workdir)
+
+def regressions(measured, baseline, compare_wall):
+    """Return the descriptions of the measurements worse than baseline"""
+    found = []
+    for metric in ('calls', 'requests'):
+        if measured[metric] > baseline[metric]:
+            found.append('%s %d > %d' % (metric, measured[metric], baseline[metric]))
+    if measured['bytes'] > baseline['bytes'] * BYTES_TOLERANCE:
+        found.append('bytes %d > %d' % (measured['bytes'], baseline['bytes']))
+    if compare_wall and measured['wall'] > baseline['wall'] * WALL_TOLERANCE + WALL_SLACK:
+        found.append('wall %.3fs > %.3fs' % (measured['wall'], baseline['wall']))
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scales', default='1,100,10000',
+                        help='comma separated object counts (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every HTTP request (default: 0)')
+    parser.add_argument('--only', action='append',
+                        help='only run the scenario of this module, repeatable')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='baseline file (default: bench/baseline.json)')
+    parser.add_argument('--compare-wall', action='store_true',
+                        help='also fail on wall time regressions, only meaningful '
+                             'on the machine that recorded the baseline')
+    parser.add_argument('--update', action='store_true',
+                        help='store the measurements as the new baseline')
+    parser.add_argument('--exec', nargs=2, metavar=('MODULE', 'ARGS_FILE'),
+                        dest='exec_args', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.exec_args:
+        exec_module(*options.exec_args)
+        return 0
+
+    try:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    except (IOError, OSError):
+        baseline = {'latency': options.latency, 'results': {}}
+    # Wall times are only comparable at the latency they were measured with
+    compare_wall = options.compare_wall and baseline.get('latency') == options.latency
+
+    failed = []
+    for scenario in SCENARIOS:
+        if options.only and scenario.module not in options.only:
+            continue
+        for scale in [int(s) for s in options.scales.split(',')]:
+            for phase, measured in sorted(run_scenario(scenario, scale, options.latency).items()):
+                key = '%s/%d/%s' % (scenario.module, scale, phase)
+                found = []
+                if key in baseline['results']:
+                    found = regressions(measured, baseline['results'][key], compare_wall)
+                if options.update:
+                    baseline['results'][key] = measured
+                print('%-36s %8.3fs %6d calls %6d requests %10d bytes %s' % (
+                    key, measured['wall'], measured['calls'], measured['requests'],
+                    measured['bytes'], 'REGRESSED: ' + ', '.join(found) if found else ''
+                ))
+                if found:
+                    failed.append(key)
+
+    if options.update:
+        baseline['latency'] = options.latency
+        with open(options.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+    elif failed:
+        print('%d regressions: %s' % (len(failed), ', '.join(failed)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,6 +3,7 @@ from setuptools import setup
 
 py_files=[
     "ansible/module_utils/zabbix",
+    "ansible/plugins/httpapi/zabbix",
 ]
 files = [
     "ansible/modules/zabbix",
@@ -21,6 +22,5 @@ setup(
     packages=files,
     install_requires = [
         'ansible>=2.0.0',
-        'zabbix-api>=0.4',
     ],
 )